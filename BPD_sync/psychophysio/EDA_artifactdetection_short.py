@@ -12,37 +12,110 @@ import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+import matplotlib.patches as mpatches
+import matplotlib.path as mpath
 import scipy.signal as scisig
 import pywt
 import os
 import datetime
+import warnings
 
+from contextlib import nullcontext
+
+from numpy.lib.stride_tricks import as_strided
 from sklearn.metrics.pairwise import rbf_kernel
 
 matplotlib.rcParams['ps.useafm'] = True
 matplotlib.rcParams['pdf.use14corefonts'] = True
 matplotlib.rcParams['text.usetex'] = True
 
-def predict_binary_classifier(X):
-    ''''
-    X: num test data by 13 features
+# names of all features in the order in which getFeatures returns them
+allFeatureNames = ['raw_amp','raw_maxd','raw_mind','raw_maxabsd','raw_avgabsd','raw_max2d','raw_min2d','raw_maxabs2d','raw_avgabs2d','filt_amp','filt_maxd','filt_mind',
+    'filt_maxabsd','filt_avgabsd','filt_max2d','filt_min2d','filt_maxabs2d','filt_avgabs2d','max_1s_1','max_1s_2','max_1s_3','mean_1s_1','mean_1s_2','mean_1s_3',
+    'std_1s_1','std_1s_2','std_1s_3','median_1s_1','median_1s_2','median_1s_3','aboveZero_1s_1','aboveZero_1s_2','aboveZero_1s_3','max_Hs_1','max_Hs_2','mean_Hs_1',
+    'mean_Hs_2','std_Hs_1','std_Hs_2','median_Hs_1','median_Hs_2','aboveZero_Hs_1','aboveZero_Hs_2']
+
+# parameters of the classifiers, they are only created or loaded once per model file
+classifier_cache = {}
+
+# resolution of the plots in the full and the fast plot mode
+plotDpi = {'full': 300, 'fast': 100}
+
+def predict_binary_classifier(X, chunk_size=None, model_file=None):
+    '''
+    X:          num test data by 13 features
+    chunk_size: number of epochs that are classified at once, None classifies all
+                epochs in one batch, smaller values bound the memory of the kernel
+    model_file: path to a .npz file with the classifier parameters, None uses the 
+                built-in EDA Explorer classifier
     '''
 
     # Get params
-    params = binary_classifier()
+    params = load_binary_classifier(model_file)
 
-    # compute kernel for all data points
-    K = rbf_kernel(params['support_vec'], X, gamma=params['gamma'])
+    if chunk_size is None:
+        chunk_size = max(X.shape[0], 1)
 
-    # Prediction = sign((sum_{i=1}^n y_i*alpha*K(x_i,x)) + rho)
     predictions = np.zeros(X.shape[0])
-    for i in range(X.shape[0]):
-        # prediction is calculated and then divided into positive (no artefact) or negative (artefact)
-        predictions[i] = np.sign(np.sum(params['dual_coef']*K[:, i]) + params['intercept'])
+    for start in range(0, X.shape[0], chunk_size):
+        # compute kernel for the data points of this chunk
+        K = rbf_kernel(params['support_vec'], X[start:start+chunk_size], gamma=params['gamma'])
+
+        # Prediction = sign((sum_{i=1}^n y_i*alpha*K(x_i,x)) + rho)
+        # the products are laid out with one row per epoch so that each sum runs 
+        # over the same contiguous values as the former per epoch computation
+        decision = np.sum(params['dual_coef']*np.ascontiguousarray(K.T), axis=1) + params['intercept']
+
+        # prediction is divided into positive (no artefact) or negative (artefact)
+        predictions[start:start+chunk_size] = np.sign(decision)
 
     return predictions
 
 
+def load_binary_classifier(model_file=None):
+    '''
+    This function returns the parameters of the binary classifier. They are created or loaded 
+    only once and the same arrays are returned for every following call.
+
+    INPUT:
+        model_file:     string, path to a .npz file containing dual_coef, support_vec, intercept and gamma,
+                        defaults to None (built-in EDA Explorer classifier)
+
+    OUTPUT:
+        params:         dictionary, contains dual_coef, support_vec, intercept and gamma
+    '''
+    if model_file not in classifier_cache:
+        if model_file is None:
+            params = binary_classifier()
+        else:
+            with np.load(model_file) as npz:
+                params = {'dual_coef': npz['dual_coef'],
+                          'support_vec': npz['support_vec'],
+                          'intercept': npz['intercept'],
+                          'gamma': float(npz['gamma'])}
+        # the cached arrays are shared by all calls, so they must not be changed
+        for value in params.values():
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+        classifier_cache[model_file] = params
+    return classifier_cache[model_file]
+
+
+def save_binary_classifier(model_file, params=None):
+    '''
+    This function saves the parameters of a binary classifier to a compact .npz file that 
+    can be used as model_file instead of the built-in classifier.
+
+    INPUT:
+        model_file:     string, path of the .npz file
+        params:         dictionary, contains dual_coef, support_vec, intercept and gamma, 
+                        defaults to None (built-in EDA Explorer classifier)
+    '''
+    if params is None:
+        params = load_binary_classifier()
+    np.savez_compressed(model_file, **params)
+
+
 def binary_classifier():
     gamma = 0.1
 
@@ -176,19 +249,86 @@ def binary_classifier():
 def interpolateDataTo8Hz(data,sample_rate):
     if sample_rate<8:
         # Upsample by linear interpolation
-        data = data.resample("125L").mean()
+        data = data.resample("125ms").mean()
     else:
         if sample_rate>8:
             # Downsample
             idx_range = list(range(0,len(data))) # TODO: double check this one
             data = data.iloc[idx_range[0::int(int(sample_rate)/8)]]
         # Set the index to be 8Hz
-        data.index = pd.timedelta_range(start='0S', periods=len(data), freq='125L')
+        data.index = pd.timedelta_range(start='0s', periods=len(data), freq='125ms')
 
     # Interpolate all empty values
     data = data.interpolate()
     return data
 
+def streamDataTo8Hz(eda,sample_rate,chunk):
+    '''
+    This function is the streaming version of interpolateDataTo8Hz followed by ffill for one signal with 
+    a regular index. It yields consecutive parts of the 8Hz signal that are identical to the in-memory version.
+
+    INPUT:
+        eda:            array, signal at its original sampling rate, index positions are the sample numbers
+        sample_rate:    float, sampling rate of eda in Hz
+        chunk:          int, number of 8Hz samples that are created at once
+
+    OUTPUT:
+        [generator]     arrays of 8Hz samples, NaN runs are held back until the next valid value is known
+    '''
+    if sample_rate<8:
+        # Upsample: every factor-th sample is a value, the others are interpolated
+        factor = int(round(8/sample_rate))
+        length = factor*(len(eda)-1)+1 if len(eda) > 0 else 0
+    else:
+        # Downsample: every step-th value is kept
+        step = int(int(sample_rate)/8)
+        length = len(range(0,len(eda),step))
+
+    # position and value of the last valid sample and the samples waiting for the next valid one
+    last_pos = None
+    last_val = None
+    pending = np.empty(0)
+    for start in range(0,length,chunk):
+        pos = np.arange(start,min(start+chunk,length))
+        if sample_rate<8:
+            part = np.full(len(pos),np.nan)
+            part[pos%factor == 0] = eda[pos[pos%factor == 0]//factor]
+        else:
+            part = eda[pos*step].astype(float)
+        part = np.concatenate([pending,part])
+        pos = np.arange(start-len(pending),pos[-1]+1)
+
+        # Interpolate the empty values between valid values (same formula as np.interp in pandas)
+        valid = np.where(~np.isnan(part))[0]
+        if len(valid) == 0:
+            if last_pos is None:
+                # no value so far, leading NaNs stay NaN
+                pending = np.empty(0)
+                yield part
+            else:
+                pending = part
+            continue
+        xp = pos[valid].astype(float)
+        fp = part[valid]
+        if last_pos is not None:
+            xp = np.concatenate([[last_pos],xp])
+            fp = np.concatenate([[last_val],fp])
+        end = valid[-1]+1
+        empty = np.where(np.isnan(part[:end]))[0]
+        if last_pos is None:
+            empty = empty[empty > valid[0]]
+        part[empty] = np.interp(pos[empty].astype(float),xp,fp)
+        last_pos = float(pos[valid[-1]])
+        last_val = part[valid[-1]]
+        pending = part[end:]
+        yield part[:end]
+
+    # empty values at the end get the last valid value
+    if len(pending) > 0:
+        if last_val is not None:
+            pending[:] = last_val
+        yield pending
+
 def butter_lowpass(cutoff, fs, order=5):
     # Filtering Helper functions
     nyq = 0.5 * fs
@@ -217,7 +357,7 @@ def getWaveletData(data):
 
     # Create wavelet dataframes
     oneSecond = pd.timedelta_range(start=startTime, periods=len(data), freq='1s')
-    halfSecond = pd.timedelta_range(start=startTime, periods=len(data), freq='500L')
+    halfSecond = pd.timedelta_range(start=startTime, periods=len(data), freq='500ms')
 
     # Compute wavelets
     cA_n, cD_3, cD_2, cD_1 = pywt.wavedec(data['eda'], 'Haar', level=3) #3 = 1Hz, 2 = 2Hz, 1=4Hz
@@ -306,41 +446,168 @@ def getFeatures(data,w1,wH):
     return list(all_feat)
 
 
-def createFeatureDF(data):
+def epochWindows(x, n, length, step):
+    '''
+    This function returns a read-only view of n overlapping windows of a 1D array without copying it
+
+    INPUT:
+        x:                  array, 1D signal
+        n:                  int, number of windows
+        length:             int, number of values in each window
+        step:               int, offset between the starts of two windows
+
+    OUTPUT:
+        windows:            array, n x length, row i contains x[i*step:i*step+length]
+    '''
+    x = np.ascontiguousarray(x, dtype=float)
+    return as_strided(x, shape=(n, length), strides=(step*x.strides[0], x.strides[0]), writeable=False)
+
+
+def getEpochDerivStats(eda, stats):
+    '''
+    Vectorized version of getDerivStats (and the amplitude of getStats), each row of eda contains the 
+    samples of one epoch. Only the requested statistics are computed and derivatives are skipped if 
+    none of their statistics is needed.
+
+    INPUT:
+        eda:                array, epochs x samples
+        stats:              list of Strings, statistics, e.g. amp, maxd or avgabs2d
+
+    OUTPUT:
+        feat:               dictionary, one array with one value per epoch for each statistic
+    '''
+    feat = {}
+    if 'amp' in stats:
+        feat['amp'] = np.mean(eda, axis=1)
+    if len(set(stats) & {'maxd','mind','maxabsd','avgabsd'}) > 0:
+        deriv = (eda[:, 1:-1] + eda[:, 2:])/ 2. - (eda[:, 1:-1] + eda[:, :-2])/ 2.
+        for stat, fun in [('maxd', np.max), ('mind', np.min)]:
+            if stat in stats:
+                feat[stat] = fun(deriv, axis=1)
+        for stat, fun in [('maxabsd', np.max), ('avgabsd', np.mean)]:
+            if stat in stats:
+                feat[stat] = fun(abs(deriv), axis=1)
+    if len(set(stats) & {'max2d','min2d','maxabs2d','avgabs2d'}) > 0:
+        second_deriv = eda[:, 2:] - 2*eda[:, 1:-1] + eda[:, :-2]
+        for stat, fun in [('max2d', np.max), ('min2d', np.min)]:
+            if stat in stats:
+                feat[stat] = fun(second_deriv, axis=1)
+        for stat, fun in [('maxabs2d', np.max), ('avgabs2d', np.mean)]:
+            if stat in stats:
+                feat[stat] = fun(abs(second_deriv), axis=1)
+    return feat
+
+
+def computeEpochWaveletFeatures(wave, stats):
+    '''
+    Vectorized version of computeWaveletFeatures for one wavelet feature, each row of wave contains the 
+    coefficients of one epoch. The statistics are computed in the same way as the pandas reductions so 
+    that the results are identical. Only the requested statistics are computed.
+
+    INPUT:
+        wave:               array, epochs x coefficients
+        stats:              list of Strings, any of max, mean, std, median and aboveZero
+
+    OUTPUT:
+        feat:               dictionary, one array with one value per epoch for each statistic
+    '''
+    count = wave.shape[1]
+    feat = {}
+    if 'max' in stats:
+        feat['max'] = np.max(wave, axis=1)
+    if ('mean' in stats) | ('std' in stats):
+        mean = np.sum(wave, axis=1)/count
+        feat['mean'] = mean
+        if 'std' in stats:
+            feat['std'] = np.sqrt(np.sum((mean[:, np.newaxis] - wave)**2, axis=1)/(count-1))
+    if 'median' in stats:
+        feat['median'] = np.median(wave, axis=1)
+    if 'aboveZero' in stats:
+        feat['aboveZero'] = np.sum(wave > 0, axis=1).astype(float)
+    return feat
+
+
+def getEpochFeatures(data,wave1sec,waveHalf,n,featureNames):
+    '''
+    This function computes the requested features for the first n epochs at once, using windows of 41 samples,
+    6 one second and 11 half second wavelet coefficients (start and end of each epoch included) 
+
+    INPUT:
+        featureNames:       list of Strings, subset of allFeatureNames
+
+    OUTPUT:
+        features:           array, n x len(featureNames), same values as the features of getFeatures
+    '''
+    feat = {}
+
+    # statistics of the raw and filtered signal
+    for prefix, column in [('raw', 'eda'), ('filt', 'filtered_eda')]:
+        stats = [name.split('_')[1] for name in featureNames if name.split('_')[0] == prefix]
+        if len(stats) > 0:
+            windows = epochWindows(data[column].values, n, 41, 40)
+            for stat, value in getEpochDerivStats(windows, stats).items():
+                feat[prefix + '_' + stat] = value
+
+    # statistics of the wavelet coefficients, names are statistic_window_feature
+    for window, waveDF, length in [('1s', wave1sec, 6), ('Hs', waveHalf, 11)]:
+        for k, column in enumerate(waveDF.columns):
+            stats = [name.split('_')[0] for name in featureNames if name.split('_')[1:] == [window, str(k+1)]]
+            if len(stats) > 0:
+                windows = epochWindows(waveDF[column].values, n, length, length-1)
+                for stat, value in computeEpochWaveletFeatures(windows, stats).items():
+                    feat[stat + '_' + window + '_' + str(k+1)] = value
+
+    return np.column_stack([feat[name] for name in featureNames])
+
+
+def createFeatureDF(data, featureNames=None):
     '''
     INPUTS:
-        filepath:           string, path to input file  
-    OUTPUTS:
-        features:           DataFrame, index is a list of timestamps for each 5 seconds, contains all the features
         data:               DataFrame, index is a list of timestamps at 8Hz, columns include eda, filtered_eda
+        featureNames:       list of Strings, features that are computed, defaults to None (all features)
+    OUTPUTS:
+        features:           DataFrame, index is a list of timestamps for each 5 seconds, contains the features
     '''
     # Load data from q sensor
     wave1sec,waveHalf = getWaveletData(data)
     
     # Create 5 second timestamp list
-    timestampList = data.index.tolist()[0::40]
+    timestampList = data.index[0::40]
     
     # feature names for DataFrame columns
-    allFeatureNames = ['raw_amp','raw_maxd','raw_mind','raw_maxabsd','raw_avgabsd','raw_max2d','raw_min2d','raw_maxabs2d','raw_avgabs2d','filt_amp','filt_maxd','filt_mind',
-        'filt_maxabsd','filt_avgabsd','filt_max2d','filt_min2d','filt_maxabs2d','filt_avgabs2d','max_1s_1','max_1s_2','max_1s_3','mean_1s_1','mean_1s_2','mean_1s_3',
-        'std_1s_1','std_1s_2','std_1s_3','median_1s_1','median_1s_2','median_1s_3','aboveZero_1s_1','aboveZero_1s_2','aboveZero_1s_3','max_Hs_1','max_Hs_2','mean_Hs_1',
-        'mean_Hs_2','std_Hs_1','std_Hs_2','median_Hs_1','median_Hs_2','aboveZero_Hs_1','aboveZero_Hs_2']
+    if featureNames is None:
+        featureNames = allFeatureNames
+    idx = [allFeatureNames.index(name) for name in featureNames]
 
     # Initialize Feature Data Frame
-    features = pd.DataFrame(np.zeros((len(timestampList),len(allFeatureNames))),columns=allFeatureNames,index=timestampList)
+    features = pd.DataFrame(np.zeros((len(timestampList),len(featureNames))),columns=featureNames,index=timestampList)
     
-    # Compute features for each 5 second epoch
-    for i in range(len(features)-1):
+    # Compute features of all 5 second epochs with complete wavelet windows at once, the 
+    # last epoch is never computed and the one before it may lack the last coefficients
+    n = max(min(len(features)-1, (len(wave1sec)-1)//5, (len(waveHalf)-1)//10), 0)
+    epochs = []
+    if n > 0:
+        all_feat = getEpochFeatures(data, wave1sec, waveHalf, n, featureNames)
+        nInf = np.isinf(all_feat).any(axis=1).sum()
+        if nInf > 0:
+            warnings.warn(str(nInf) + ' epochs have infinite features')
+        # epochs containing NaNs are computed one by one like the remaining epochs
+        epochs = list(np.where(np.isnan(all_feat).any(axis=1))[0])
+        features.iloc[:n] = all_feat
+    epochs = epochs + list(range(n, len(features)-1))
+    
+    # Compute features for each remaining 5 second epoch
+    for i in epochs:
         start = features.index[i]
         end = features.index[i+1]
         this_data = data[start:end]
         this_w1 = wave1sec[start:end]
         this_w2 = waveHalf[start:end]
-        features.iloc[i] = getFeatures(this_data,this_w1,this_w2)
+        features.iloc[i] = np.array(getFeatures(this_data,this_w1,this_w2))[idx]
     return features
 
 
-def classifyEpochs(features,featureNames,classifierName):
+def classifyEpochs(features,featureNames,classifierName,chunk_size=None,model_file=None):
     '''
     This function takes the full features DataFrame and classifies each 5 second epoch into artifact, questionable, or clean
 
@@ -348,6 +615,8 @@ def classifyEpochs(features,featureNames,classifierName):
         features:           DataFrame, index is a list of timestamps for each 5 seconds, contains all the features
         featureNames:       list of Strings, subset of feature names needed for classification
         classifierName:     string, type of SVM (binary or multiclass)
+        chunk_size:         int, number of epochs classified at once, defaults to None (all epochs at once)
+        model_file:         string, path to a .npz file with the classifier parameters, defaults to None (built-in classifier)
 
     OUTPUTS:
         labels:             Series, index is a list of timestamps for each 5 seconds, values of -1, 0, or 1 for artifact, questionable, or clean
@@ -357,7 +626,7 @@ def classifyEpochs(features,featureNames,classifierName):
     X = features[featureNames].values
 
     # Classify each 5 second epoch and put into DataFrame
-    featuresLabels = predict_binary_classifier(X)
+    featuresLabels = predict_binary_classifier(X, chunk_size, model_file)
     
     return featuresLabels
 
@@ -383,12 +652,15 @@ def getSVMFeatures(key):
         return
 
 
-def classify(data):
+def classify(data, model_file=None, timer=None):
     '''
     This function wraps other functions in order to load, classify, and return the label for each 5 second epoch of Q sensor data.
 
     INPUT:
         data
+        model_file:             string, path to a .npz file with the classifier parameters, defaults to None (built-in classifier)
+        timer:                  function called as timer(stageName, samples=samples) returning a context manager that measures 
+                                the feature extraction and the classification, defaults to None (not measured)
     OUTPUT:
         featureLabels:          Series, index is a list of timestamps for each 5 seconds, values of -1, 0, or 1 for artifact, questionable, or clean
         data:                   DataFrame, only output if fullFeatureOutput=1, index is a list of timestamps at 8Hz, columns include eda, filtered_eda
@@ -400,14 +672,148 @@ def classify(data):
     # Get pickle List and featureNames list
     featureNames = getSVMFeatures(classifierName)
 
-    # Create the feature array and then apply the classifier    
-    features = createFeatureDF(data)
-    labels   = classifyEpochs(features, featureNames, classifierName)
+    # Create the feature array with only the features of this classifier and then apply the classifier    
+    if timer is None:
+        timer = lambda stageName, samples=None: nullcontext()
+    with timer('artefact_features', samples=len(data)):
+        features = createFeatureDF(data, featureNames)
+    with timer('svm', samples=len(features)):
+        labels   = classifyEpochs(features, featureNames, classifierName, model_file=model_file)
 
     return labels, data
 
 
-def plotData(data, labels, filepath, part, tag, filteredPlot=0, secondsPlot=0):
+def classifyStream(eda, sample_rate, chunk_epochs, model_file=None, timer=None):
+    '''
+    This function is the streaming version of the 8Hz conversion, filtering and classify. It works through the signal in 
+    windows of chunk_epochs 5 second epochs. The filter state and the alignment of the Haar wavelets are carried over 
+    from one window to the next, so the labels are identical to the in-memory version while the memory stays constant.
+
+    INPUT:
+        eda:                    array, EDA signal at its original sampling rate with a regular index
+        sample_rate:            float, sampling rate of eda in Hz
+        chunk_epochs:           int, number of 5 second epochs per window
+        model_file:             string, path to a .npz file with the classifier parameters, defaults to None (built-in classifier)
+        timer:                  function returning a context manager that measures each step of each window, see classify
+    OUTPUT:
+        labels:                 array, values of -1 or 1 for each 5 second epoch
+        envelope:               DataFrame, minimum and maximum of eda and filtered_eda in each 5 second epoch
+    '''
+    classifierName = 'Binary'
+    featureNames = getSVMFeatures(classifierName)
+    if timer is None:
+        timer = lambda stageName, samples=None: nullcontext()
+
+    # low-pass butterworth filter (cutoff:1hz, fs:8hz, order:6) with its state
+    b, a = butter_lowpass(1.0, 8, 6)
+    zi = np.zeros(max(len(a),len(b))-1)
+
+    # each window contains its epochs plus one wavelet block (8 samples) of the next epoch
+    size = chunk_epochs*40
+    buffer = np.empty((0,2))
+    last = np.nan
+    labels = []
+    envelope = []
+
+    def classifyWindow(window, final):
+        data = pd.DataFrame(window,columns=['eda','filtered_eda'],
+                            index=pd.timedelta_range(start='0s',periods=len(window),freq='125ms'))
+        with timer('artefact_features', samples=len(window)):
+            features = createFeatureDF(data, featureNames)
+        n = int(np.ceil(len(window)/40.0)) if final else chunk_epochs
+        edges = np.arange(0,n*40,40)
+        envelope.append(np.column_stack([np.minimum.reduceat(window[:n*40],edges,axis=0),
+                                         np.maximum.reduceat(window[:n*40],edges,axis=0)]))
+        with timer('svm', samples=n):
+            labels.append(classifyEpochs(features.iloc[:n],featureNames,classifierName,model_file=model_file))
+
+    for part in streamDataTo8Hz(eda,sample_rate,size):
+        # forward propagate data to fill NAs
+        part = pd.Series(np.concatenate([[last],part])).ffill().values[1:]
+        if len(part) > 0:
+            last = part[-1]
+        filtered, zi = scisig.lfilter(b, a, part, zi=zi)
+        buffer = np.concatenate([buffer,np.column_stack([part,filtered])])
+        # only complete windows that are not the last one are classified now
+        while len(buffer) > size+8:
+            classifyWindow(buffer[:size+8], False)
+            buffer = buffer[size:]
+    if len(buffer) > 0:
+        classifyWindow(buffer, True)
+
+    envelope = pd.DataFrame(np.concatenate(envelope) if len(envelope) > 0 else np.empty((0,4)),
+                            columns=['eda_min','filtered_eda_min','eda_max','filtered_eda_max'])
+    return np.concatenate(labels) if len(labels) > 0 else np.empty(0), envelope
+
+
+def minMaxEnvelope(x, y, nBins):
+    '''
+    This function reduces a trace to the minimum and the maximum of nBins groups of consecutive samples. Drawn 
+    as one line, the result looks like the full trace when the axis is no wider than nBins pixels, but the 
+    number of points does not depend on the length of the recording.
+
+    INPUT:
+        x:                      array, x values of the trace
+        y:                      array, y values of the trace, NaNs are ignored within a group
+        nBins:                  int, number of groups, e.g. the width of the figure in pixels
+
+    OUTPUT:
+        x, y:                   arrays with the x value of the first sample of each group twice and the minimum 
+                                and the maximum of each group, unchanged if there are no more than 2*nBins samples
+    '''
+    y = np.asarray(y, dtype=float)
+    if len(y) <= 2*nBins:
+        return x, y
+    starts = (np.arange(nBins)*len(y))//nBins
+    envelope = np.column_stack([np.fmin.reduceat(y, starts), np.fmax.reduceat(y, starts)])
+    return np.repeat(np.asarray(x)[starts], 2), envelope.ravel()
+
+
+def mergeSpans(labels, value):
+    '''
+    This function finds runs of consecutive epochs with the same label so that each run can be shaded with one 
+    span instead of one span per epoch.
+
+    INPUT:
+        labels:                 array, each row is a 5 second period
+        value:                  label of the epochs that are merged, e.g. -1 for artifacts
+
+    OUTPUT:
+        starts, ends:           arrays, first epoch of each run and the epoch after its last epoch
+    '''
+    mask = np.concatenate([[False], np.asarray(labels) == value, [False]])
+    edges = np.flatnonzero(np.diff(mask.astype(np.int8)))
+    return edges[0::2], edges[1::2]
+
+
+def shadeSpans(ax, labels, value, scale, **kwargs):
+    '''
+    This function shades all runs of epochs with the given label over the full height of the axis. The runs are 
+    drawn as one patch, so neither drawing nor placing the legend depends on the number of runs.
+
+    INPUT:
+        ax:                     axis to shade
+        labels:                 array, each row is a 5 second period
+        value:                  label of the epochs that are shaded, e.g. -1 for artifacts
+        scale:                  float, 1 for an x-axis in seconds, 60 for minutes
+        kwargs:                 passed on to the patch, e.g. facecolor and alpha
+
+    OUTPUT:
+        patch:                  the added patch or None if no epoch has the label
+    '''
+    starts, ends = mergeSpans(labels, value)
+    if len(starts) == 0:
+        return None
+    x0 = starts*5.0/scale
+    x1 = ends*5.0/scale
+    rects = np.stack([np.column_stack([x0, np.zeros(len(x0))]), np.column_stack([x1, np.zeros(len(x0))]), 
+                      np.column_stack([x1, np.ones(len(x0))]), np.column_stack([x0, np.ones(len(x0))])], axis=1)
+    patch = mpatches.PathPatch(mpath.Path.make_compound_path_from_polys(rects), transform=ax.get_xaxis_transform(), **kwargs)
+    ax.add_patch(patch)
+    return patch
+
+
+def plotData(data, labels, filepath, part, tag, filteredPlot=0, secondsPlot=0, plots='full'):
     '''
     This function plots the Q sensor EDA data with shading for artifact (red) and questionable data (grey). 
         Note that questionable data will only appear if you choose a multiclass classifier
@@ -417,6 +823,8 @@ def plotData(data, labels, filepath, part, tag, filteredPlot=0, secondsPlot=0):
         labels:                 array, each row is a 5 second period and each column is a different classifier
         filteredPlot:           binary, 1 for including filtered EDA in plot, 0 for only raw EDA on the plot, defaults to 0
         secondsPlot:            binary, 1 for x-axis in seconds, 0 for x-axis in minutes, defaults to 0
+        plots:                  'full' for 300 dpi, 'fast' for 100 dpi without LaTeX, defaults to 'full', 
+                                long recordings are drawn as min/max envelope with one point pair per pixel
 
     OUTPUT:
         [plot]                  the resulting plot has N subplots (where N is the length of classifierList) that have linked x and y axes 
@@ -431,76 +839,172 @@ def plotData(data, labels, filepath, part, tag, filteredPlot=0, secondsPlot=0):
         scale = 60.0
     time_m = np.arange(0,len(data))/(8.0*scale)
     
-    # Initialize Figure
-    plt.figure(figsize=(10,5))
-
-    # For each classifier, label each epoch and plot
-    key = 'Binary'
+    # one minimum and maximum per pixel of the figure width
+    nBins = 10*plotDpi[plots]
+    
+    with plt.rc_context({'text.usetex': False} if plots == 'fast' else {}):
+    
+        # Initialize Figure
+        plt.figure(figsize=(10,5))
+
+        # For each classifier, label each epoch and plot
+        key = 'Binary'
+            
+        # Initialize Subplots
+        ax = plt.subplot(1,1,1)
+
+        # Plot EDA
+        lines = ax.plot(*minMaxEnvelope(time_m,data['eda'].values,nBins))
+
+        # Shade consecutive artifact (red) and questionable (grey) epochs
+        shadeSpans(ax, labels[:-1], -1, scale, facecolor='red', alpha=0.7, edgecolor ='none')
+        shadeSpans(ax, labels[:-1], 0, scale, facecolor='.5', alpha=0.5, edgecolor ='none')
+
+        # Plot filtered data if requested
+        if filteredPlot:
+            lines += ax.plot(*minMaxEnvelope(time_m-.625/scale,data['filtered_eda'].values,nBins), c='g')
+            plt.legend(lines,['Raw SC','Filtered SC'],loc=0)
+
+        # Label and Title each subplot
+        plt.ylabel('$\mu$S')
+        plt.title(key)
         
-    # Initialize Subplots
-    ax = plt.subplot(1,1,1)
-
-    # Plot EDA
-    ax.plot(time_m,data['eda'])
-
-    # For each epoch, shade if necessary
-    for i in range(0,len(labels)-1):
-        if labels[i]==-1:
-            # artifact
-            start = i*40/(8.0*scale)
-            end = start+5.0/scale
-            ax.axvspan(start, end, facecolor='red', alpha=0.7, edgecolor ='none')
-        elif labels[i]==0:
-            # Questionable
-            start = i*40/(8.0*scale)
-            end = start+5.0/scale
-            ax.axvspan(start, end, facecolor='.5', alpha=0.5,edgecolor ='none')
-
-    # Plot filtered data if requested
-    if filteredPlot:
-        ax.plot(time_m-.625/scale,data['filtered_eda'], c='g')
-        plt.legend(['Raw SC','Filtered SC'],loc=0)
-
-    # Label and Title each subplot
-    plt.ylabel('$\mu$S')
-    plt.title(key)
+        # Only include x axis label on final subplot
+        if secondsPlot:
+            plt.xlabel('Time (s)')    
+        else:
+            plt.xlabel('Time (min)')
+
+        # Display the plot
+        plt.subplots_adjust(hspace=.3)
+        plt.show()
+        plt.savefig(os.path.join(filepath, part + '_' + tag + '_artefacts.png'), dpi = plotDpi[plots])
+        plt.close()
     
-    # Only include x axis label on final subplot
+    return
+
+
+def plotEnvelope(envelope, labels, filepath, part, tag, secondsPlot=0, plots='full'):
+    '''
+    This function plots the minimum and maximum of the raw (blue) and filtered (green) EDA in each 5 second epoch 
+    with shading for artifact (red) data. It is used instead of plotData when the data is classified in windows.
+
+    INPUT:
+        envelope:               DataFrame, one row per 5 second epoch, columns include eda_min, filtered_eda_min, eda_max, filtered_eda_max
+        labels:                 array, each row is a 5 second period
+        secondsPlot:            binary, 1 for x-axis in seconds, 0 for x-axis in minutes, defaults to 0
+        plots:                  'full' for 300 dpi, 'fast' for 100 dpi without LaTeX, defaults to 'full'
+    '''
+
+    # Initialize x axis
     if secondsPlot:
-        plt.xlabel('Time (s)')    
+        scale = 1.0
     else:
-        plt.xlabel('Time (min)')
-
-    # Display the plot
-    plt.subplots_adjust(hspace=.3)
-    plt.show()
-    plt.savefig(os.path.join(filepath, part + '_' + tag + '_artefacts.png'), dpi = 300)
+        scale = 60.0
+    time_m = np.arange(0,len(envelope))*5.0/scale
+
+    # combine epochs so there is at most one step per pixel of the figure width
+    nBins = 10*plotDpi[plots]
+    if len(envelope) > nBins:
+        starts = (np.arange(nBins)*len(envelope))//nBins
+        time_m = time_m[starts]
+        envelope = pd.DataFrame({col: (np.fmin if col.endswith('_min') else np.fmax).reduceat(envelope[col].values, starts) 
+                                 for col in ['eda_min','filtered_eda_min','eda_max','filtered_eda_max']})
+
+    with plt.rc_context({'text.usetex': False} if plots == 'fast' else {}):
+
+        # Initialize Figure
+        plt.figure(figsize=(10,5))
+        ax = plt.subplot(1,1,1)
+
+        # Plot EDA
+        fills = [ax.fill_between(time_m,envelope['eda_min'],envelope['eda_max'],step='post',linewidth=0.5),
+                 ax.fill_between(time_m,envelope['filtered_eda_min'],envelope['filtered_eda_max'],step='post',color='g',alpha=0.5,linewidth=0)]
+
+        # Shade consecutive artifact epochs
+        shadeSpans(ax, labels[:-1], -1, scale, facecolor='red', alpha=0.7, edgecolor ='none')
+
+        plt.legend(fills,['Raw SC','Filtered SC'],loc=0)
+        plt.ylabel('$\mu$S')
+        plt.title('Binary')
+        if secondsPlot:
+            plt.xlabel('Time (s)')    
+        else:
+            plt.xlabel('Time (min)')
+
+        plt.savefig(os.path.join(filepath, part + '_' + tag + '_artefacts.png'), dpi = plotDpi[plots])
+        plt.close()
     
     return
 
 
+def isStreamable(df_eda, sample_rate):
+    '''
+    This function checks whether the EDA can be classified in windows: upsampling needs a whole-numbered 
+    factor and a regular index that starts on the 8Hz grid, downsampling only uses the sample positions.
+    '''
+    if sample_rate >= 8:
+        return True
+    if (8/sample_rate) != round(8/sample_rate):
+        return False
+    stamps = df_eda.index.asi8
+    return (stamps[0] % 125000000 == 0) & np.all(np.diff(stamps) == int(round(1e9/sample_rate)))
+
+
 #if __name__ == "__main__":
-def EDA_artifact_detection(dict_df, dir_out, part, tag):
-    
-    # make sure data has 8Hz
-    data  = interpolateDataTo8Hz(dict_df['eda'], (1/dict_df['eda']['sampRate'].iloc[0]))
-    
-    # forward propagate data to fill NAs after merging
-    data = data.ffill()
+def EDA_artifact_detection(dict_df, dir_out, part, tag, model_file=None, chunk_epochs=None, plots='full', submit=None, timer=None):
+    '''
+    This function detects artefacts in the EDA of one block, plots them and saves the labels.
+
+    INPUT:
+        dict_df:                dictionary, contains the DataFrame of the EDA under eda
+        chunk_epochs:           int, number of 5 second epochs that are classified at once in the streaming mode, 
+                                defaults to None (whole block in memory)
+        plots:                  'full', 'fast' or 'none', see plotData, defaults to 'full'
+        submit:                 function called as submit(plotFunction, *args) to render the plot, e.g. in a 
+                                background process, defaults to None (plot rendered directly)
+        timer:                  function called as timer(stageName, samples=samples) returning a context manager that measures 
+                                the feature extraction and the classification, defaults to None (not measured)
+    '''
+
+    if submit is None:
+        submit = lambda fun, *args: fun(*args)
+
+    sample_rate = 1/dict_df['eda']['sampRate'].iloc[0]
+
+    if (chunk_epochs is not None) and isStreamable(dict_df['eda'], sample_rate):
+
+        # classify the data in windows of chunk_epochs epochs
+        labels, envelope = classifyStream(dict_df['eda']['eda'].values, sample_rate, chunk_epochs, model_file, timer)
+        start = dict_df['eda'].index[0] if sample_rate < 8 else pd.Timedelta(0)
+
+        # plot data
+        if plots != 'none':
+            submit(plotEnvelope, envelope, labels, dir_out, part, tag, 0, plots)
+
+    else:
     
-    # get the filtered data using a low-pass butterworth filter (cutoff:1hz, fs:8hz, order:6)
-    data['filtered_eda'] =  butter_lowpass_filter(data['eda'], 1.0, 8, 6)
+        # make sure data has 8Hz
+        data  = interpolateDataTo8Hz(dict_df['eda'], sample_rate)
+        
+        # forward propagate data to fill NAs after merging
+        data = data.ffill()
+        
+        # get the filtered data using a low-pass butterworth filter (cutoff:1hz, fs:8hz, order:6)
+        data['filtered_eda'] =  butter_lowpass_filter(data['eda'], 1.0, 8, 6)
 
-    # classify the data
-    labels, data = classify(data)
+        # classify the data
+        labels, data = classify(data, model_file, timer)
+        start = data.index[0]
 
-    # plot data
-    plotData(data, labels, dir_out, part, tag, 1, 0)    
+        # plot data
+        if plots != 'none':
+            submit(plotData, data, labels, dir_out, part, tag, 1, 0, plots)
 
     # save labels
     fullOutputPath = os.path.join(dir_out, part + '_' + tag + '_artefacts.csv')
 
-    featureLabels = pd.DataFrame(labels, index=pd.timedelta_range(start=data.index[0], periods=len(labels), freq='5s'),
+    featureLabels = pd.DataFrame(labels, index=pd.timedelta_range(start=start, periods=len(labels), freq='5s'),
                                  columns=['Binary'])
 
     featureLabels.reset_index(inplace=True)
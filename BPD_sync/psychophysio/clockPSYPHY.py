@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Sample clock of a regularly sampled signal for preproPSYPHY. A clock consists
+of the time stamp of its first sample and the sampling period as an exact
+fraction of seconds, e.g. 1/64 for BVP recorded at 64 Hz. The time stamp of
+any sample and the sample at or after any time are computed with integer
+arithmetic, so neither a frequency string has to be parsed nor an index has to
+be searched, and the time stamps do not drift for periods which are not a
+whole number of nanoseconds.
+
+Data frames which lie exactly on a clock carry it in df.attrs['clock']. Since
+pandas passes attrs on to slices and copies, get_clock checks that the first
+and the last row of a data frame are still on the clock before using it.
+
+Classes:
+    SampleClock : start time and exact sampling period of a signal
+
+Functions:
+    set_clock   : attaching a clock to a data frame
+    get_clock   : the clock of the first row of a data frame or None
+
+"""
+
+import numpy as np
+import pandas as pd
+
+from datetime import timedelta
+from fractions import Fraction
+
+class SampleClock:
+    '''
+    Clock of a regularly sampled signal. Sample i is taken at start + i*period,
+    rounded down to the nanosecond.
+
+    INPUT:
+        start:                  time stamp (pd.Timestamp, datetime) or time since the start of
+                                a block (pd.Timedelta) of the first sample
+        period:                 sampling period in seconds, converted to a Fraction
+        first:                  number of the first sample counted from start, used by shift
+                                so shifted clocks stay exactly on the same grid
+    '''
+
+    def __init__(self, start, period, first = 0):
+        if isinstance(start, (pd.Timedelta, timedelta, np.timedelta64)):
+            self.start = pd.Timedelta(start)
+        else:
+            self.start = pd.Timestamp(start)
+        self.period = Fraction(period)
+        self.first  = int(first)
+        if self.period <= 0:
+            raise ValueError('The sampling period has to be positive, not ' + str(self.period))
+
+        # the period in nanoseconds as whole and fractional part: step + rest/denominator
+        period_ns = self.period*10**9
+        self._step, self._rest = divmod(period_ns.numerator, period_ns.denominator)
+        self._den = period_ns.denominator
+
+    @classmethod
+    def from_rate(cls, start, rate):
+        # clock from a sampling rate in Hz, rates given as floats are converted
+        # to the closest fraction with a denominator of at most one million
+        return cls(start, (1/Fraction(rate)).limit_denominator(10**6))
+
+    def __repr__(self):
+        return 'SampleClock(' + repr(self.start) + ', ' + str(self.period) + ', ' + str(self.first) + ')'
+
+    def __eq__(self, other):
+        return isinstance(other, SampleClock) and self.start == other.start and self.period == other.period and self.first == other.first
+
+    def offset_ns(self, i):
+        # nanoseconds between start and sample i, exact for any period and
+        # without overflow for hundreds of millions of samples
+        i = np.asarray(i, dtype = np.int64) + self.first
+        return i*self._step + (i*self._rest)//self._den
+
+    def time(self, i):
+        # time stamp(s) of sample(s) i
+        if np.ndim(i) == 0:
+            return self.start + pd.Timedelta(int(self.offset_ns(i)), unit = 'ns')
+        return self.start + pd.to_timedelta(self.offset_ns(i), unit = 'ns')
+
+    def index(self, n, first = 0):
+        # index of n samples starting with sample first
+        offsets = self.offset_ns(np.arange(first, first + n, dtype = np.int64))
+        if isinstance(self.start, pd.Timedelta):
+            return pd.TimedeltaIndex((self.start.value + offsets).view('timedelta64[ns]'))
+        return pd.DatetimeIndex((self.start.value + offsets).view('datetime64[ns]'))
+
+    def sample(self, t, side = 'left'):
+        # first sample at or after ('left') or after ('right') the time(s) t,
+        # the same as searchsorted on the index of all samples of the clock
+        scalar = np.ndim(t) == 0
+        if scalar:
+            t = [t]
+        if isinstance(self.start, pd.Timedelta):
+            d = pd.to_timedelta(t).asi8 - self.start.value
+        else:
+            d = pd.DatetimeIndex(t).asi8 - self.start.value
+        d = np.asarray(d, dtype = np.int64) + (1 if side == 'right' else 0)
+
+        # estimate with floating point numbers, then correct by one sample in
+        # either direction with the exact offsets
+        k = np.ceil(d/float(self.period*10**9)).astype(np.int64) - self.first
+        k = k + (self.offset_ns(k) < d)
+        k = k - (self.offset_ns(k - 1) >= d)
+
+        return int(k[0]) if scalar else k
+
+    def shift(self, k):
+        # clock whose first sample is sample k of this clock
+        return SampleClock(self.start, self.period, self.first + k)
+
+    def rebase(self, start):
+        # clock with the same period whose first sample is at start
+        return SampleClock(start, self.period)
+
+    def to_dict(self):
+        # plain description of the clock that can be saved as JSON
+        return {'start': str(self.start), 'timedelta': isinstance(self.start, pd.Timedelta),
+                'period': str(self.period), 'first': self.first}
+
+    @classmethod
+    def from_dict(cls, d):
+        # clock from a description written by to_dict
+        start = pd.Timedelta(d['start']) if d['timedelta'] else pd.Timestamp(d['start'])
+        return cls(start, Fraction(d['period']), d['first'])
+
+def set_clock(df, clock):
+    # attaching the clock of the first row to a data frame
+
+    df.attrs['clock'] = clock
+    return df
+
+def get_clock(df):
+    # the clock of the first row of a data frame if its first and last row lie
+    # on the clock attached to it or to the data frame it was cut from, else None
+
+    clock = df.attrs.get('clock') if hasattr(df, 'attrs') else None
+    if clock is None or len(df) == 0:
+        return clock
+    try:
+        k = clock.sample(df.index[0])
+        if clock.time(k) != df.index[0] or clock.time(k + len(df) - 1) != df.index[-1]:
+            return None
+    except (TypeError, ValueError):
+        # e.g. a clock of time stamps on a data frame with a timedelta index
+        return None
+
+    return clock.shift(k)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Raw array format for the result tables of preproPSYPHY. Every table is saved
+as one binary file (.dat) in which the columns are stored one after the other
+and a small JSON header (.json) with the length, the data type and the offset
+of each column as well as the time index. The columns can then be memory
+mapped, so windows of the signals are returned as NumPy views without reading
+or copying the file. The header is plain JSON and the data is in native byte
+order, so the files can also be read from other languages, e.g. with readBin
+in R.
+
+Functions:
+    write_memmap : saving a data frame as fl.dat and fl.json
+    read_header  : reading the header of a table
+    open_memmap  : memory mapping all or some columns of a table
+    window_rows  : rows of a time window
+    read_window  : views of the rows of a time window, in seconds or as timedelta
+    read_memmap  : reading a whole table back into a data frame, optionally without copying
+
+"""
+
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from datetime import datetime, timedelta
+
+def write_memmap(df, fl):
+    # saving a data frame as raw arrays with a JSON header, fl is the path
+    # without file extension. Evenly spaced time indices are saved in the header
+    # as start and step, all other indices as an additional column
+
+    # describe the index
+    index  = df.index
+    values = index.asi8 if isinstance(index, (pd.TimedeltaIndex, pd.DatetimeIndex)) else None
+    if isinstance(index, pd.RangeIndex):
+        dict_index = {'kind': 'range', 'start': index.start, 'step': index.step}
+    elif values is not None and (len(values) < 2 or np.all(np.diff(values) == values[1] - values[0])):
+        dict_index = {'kind': 'timedelta' if isinstance(index, pd.TimedeltaIndex) else 'datetime',
+                      'start': int(values[0]) if len(values) > 0 else 0,
+                      'step': int(values[1] - values[0]) if len(values) > 1 else 0}
+    else:
+        dict_index = {'kind': 'column'}
+    dict_index['name'] = index.name
+
+    # collect the columns with fixed data types, strings are saved with a fixed length
+    ls_cols = [(str(col), df[col].to_numpy()) for col in df.columns]
+    if dict_index['kind'] == 'column':
+        ls_cols.append(('__index__', index.to_numpy()))
+    ls_cols = [(col, arr.astype(str) if arr.dtype == object else arr) for col, arr in ls_cols]
+
+    # write the columns one after the other, each starting at a multiple of 64 bytes
+    header = {'length': len(df), 'index': dict_index, 'columns': []}
+    with open(fl + '.dat.tmp', 'wb') as fl_dat:
+        for col, arr in ls_cols:
+            offset = fl_dat.tell()
+            offset = offset + (-offset % 64)
+            fl_dat.seek(offset)
+            fl_dat.write(np.ascontiguousarray(arr).tobytes())
+            header['columns'].append({'name': col, 'dtype': arr.dtype.str, 'offset': offset})
+
+    # the header is written last, so a table without header is incomplete
+    with open(fl + '.json.tmp', 'w') as fl_json:
+        json.dump(header, fl_json, indent = 1)
+    os.replace(fl + '.dat.tmp', fl + '.dat')
+    os.replace(fl + '.json.tmp', fl + '.json')
+
+def read_header(fl):
+    # reading the JSON header of a table, fl is the path without file extension
+
+    with open(fl + '.json') as fl_json:
+        return json.load(fl_json)
+
+def open_memmap(fl, columns = None, header = None, mode = 'r'):
+    # memory mapping the columns of a table, returns a dictionary with one
+    # array per column that is only read from disk when accessed. The arrays 
+    # are read-only with mode 'r' and copy-on-write with mode 'c', i.e. changes 
+    # stay in the memory of the process and never reach the file
+
+    if header is None:
+        header = read_header(fl)
+
+    dict_mm = {}
+    for col in header['columns']:
+        if columns is not None and col['name'] not in columns:
+            continue
+        if header['length'] == 0:
+            dict_mm[col['name']] = np.empty(0, dtype = col['dtype'])
+        else:
+            dict_mm[col['name']] = np.memmap(fl + '.dat', dtype = col['dtype'], mode = mode,
+                                             offset = col['offset'], shape = (header['length'],))
+
+    return dict_mm
+
+def window_rows(header, start = None, stop = None, index = None):
+    # converting a window into the first and the last row (exclusive). For time 
+    # indices, start and stop are seconds or timedeltas from the start of the 
+    # index or, for datetime indices, also time stamps. For range indices, they 
+    # are values of the index. index is the index column if it is not evenly spaced
+    
+    dict_index = header['index']
+    n = header['length']
+    if n == 0:
+        return 0, 0
+    first = dict_index['start'] if dict_index['kind'] != 'column' else int(index.view(np.int64)[0])
+    
+    ls_rows = []
+    for t, default in zip([start, stop], [0, n]):
+        if t is None:
+            ls_rows.append(default)
+            continue
+        # offset to the first value of the index in the unit of the index
+        if dict_index['kind'] == 'range':
+            offset = t - first
+        elif isinstance(t, (pd.Timestamp, datetime, np.datetime64, str)):
+            offset = pd.Timestamp(t).value - first
+        else:
+            offset = pd.Timedelta(t if isinstance(t, (pd.Timedelta, timedelta, np.timedelta64)) else pd.Timedelta(seconds = t)).value
+        # find the first row at or after the offset
+        if dict_index['kind'] == 'column':
+            row = int(np.searchsorted(index.view(np.int64), first + offset, side = 'left'))
+        elif dict_index['step'] == 0:
+            row = 0 if offset <= 0 else n
+        else:
+            row = math.ceil(offset/dict_index['step'])
+        ls_rows.append(min(max(row, 0), n))
+    
+    return ls_rows[0], max(ls_rows[0], ls_rows[1])
+
+def read_window(fl, start = None, stop = None, columns = None):
+    # returning views of the rows between start and stop (exclusive) of all or 
+    # some columns of a table, see window_rows for start and stop. Nothing is 
+    # copied, the data is only read when the views are accessed
+    
+    header  = read_header(fl)
+    dict_mm = open_memmap(fl, None if columns is None else list(columns) + ['__index__'], header)
+    i0, i1  = window_rows(header, start, stop, dict_mm.get('__index__'))
+    
+    return {col: arr[i0:i1] for col, arr in dict_mm.items() if col != '__index__' or columns is None}
+
+def read_memmap(fl, mode = 'r', copy = True):
+    # reading a whole table back into a data frame with its original index. 
+    # With copy False, the columns of the data frame are the memory mapped 
+    # arrays themselves, see open_memmap for mode
+    
+    header     = read_header(fl)
+    dict_mm    = open_memmap(fl, header = header, mode = mode)
+    dict_index = header['index']
+    n          = header['length']
+    
+    # restore the index
+    if dict_index['kind'] == 'range':
+        index = pd.RangeIndex(dict_index['start'], dict_index['start'] + n*dict_index['step'], dict_index['step'])
+    elif dict_index['kind'] == 'column':
+        index = pd.Index(np.array(dict_mm.pop('__index__')))
+    else:
+        values = dict_index['start'] + dict_index['step']*np.arange(n, dtype = np.int64)
+        index  = pd.TimedeltaIndex(values.view('timedelta64[ns]')) if dict_index['kind'] == 'timedelta' else pd.DatetimeIndex(values.view('datetime64[ns]'))
+    index.name = dict_index['name']
+    
+    if copy:
+        dict_mm = {col: np.array(arr) for col, arr in dict_mm.items()}
+    return pd.DataFrame(dict_mm, index = index, columns = list(dict_mm.keys()), copy = False)
@@ -12,10 +12,24 @@ it also draws inspiration from Ledalab.
 Arguments: 
     empatica   : either 'e4' or 'e+' or 'cut' (4Hz EDA and 64Hz BVP only)
     winwidth   : width of the window for smoothing of EDA with Gaussian kernel (int)
+    smooth_backend: convolution of the Gaussian smoothing: 'direct' (exact), 'fft' (faster for wide windows) or 'auto' (fft for wide windows on long blocks)
     lowpass    : lowpass filter frequency for EDA - has to be no larger than half the sample rate
     dir_out    : output directory for all the results
     dir_path   : input directory
     exclude    : list of patterns to be excluded from preprocessing
+    n_jobs     : number of participants processed in parallel worker processes
+    svm_model  : path to a .npz file with the parameters of the artefact classifier (None = EDA Explorer)
+    art_chunk  : number of 5 second epochs per window when detecting artefacts window by window (None = whole block)
+    n_jobs_avro: number of worker processes decoding the avro files of one participant (E+ only)
+    cache_dir  : directory for caching the converted raw data of each participant as parquet files (None = no cache, needs pyarrow)
+    cache_size : maximum size of the cache directory in GB, least recently used entries are removed first
+    resume     : whether stages that are up to date according to the manifest of a participant are skipped
+    out_format : format of the result tables: 'csv', 'parquet' or 'feather' (typed and compressed) or 'hdf5' (one store for all result tables, artefact labels, figures and manifests stay files) or 'memmap' (raw arrays, see memmapPSYPHY)
+    plots      : 'full' (all figures at 300 dpi), 'fast' (min/max envelopes at 100 dpi without LaTeX) or 'none'
+    plot_jobs  : number of processes rendering the figures in the background (0 = figures are rendered directly)
+    n_jobs_block: number of worker processes preprocessing the blocks of one participant, the cut data is shared through memory mapped files
+    overlap_stages: whether BVP is preprocessed in one separate process per participant while EDA, temperature and acceleration of the same block are processed (only if n_jobs_block = 1)
+    report     : whether the time and memory of every stage are appended to a .jsonl file next to the log file, one run id per run, see timingPSYPHY
 
 The function creates preprocessed data files for EDA and BVP as well as plots 
 to check the data quality. 
@@ -33,8 +47,14 @@ import matplotlib.pyplot as plt
 import scipy
 import simple_colors
 import math
+import functools
 import glob
+import hashlib
+import io
+import json
 import os
+import shutil
+import tempfile
 import warnings
 
 #warnings.simplefilter('ignore', UserWarning)
@@ -42,54 +62,254 @@ warnings.filterwarnings('ignore')
 
 from avro.datafile import DataFileReader
 from avro.io import DatumReader
+try:
+    # optional: considerably faster reading of the Embrace Plus avro files
+    import fastavro
+except ImportError:
+    fastavro = None
+try:
+    # optional: faster parsing of the E4 csv files
+    import pyarrow
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa_csv = None
+try:
+    # optional: locking of the hdf5 store when several processes write to it
+    import fcntl
+except ImportError:
+    fcntl = None
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
+from fractions import Fraction
 
-from EDA_artifactdetection_short import EDA_artifact_detection
+from EDA_artifactdetection_short import EDA_artifact_detection, minMaxEnvelope
+from memmapPSYPHY import write_memmap, read_memmap
+from clockPSYPHY import SampleClock, set_clock, get_clock
+from timingPSYPHY import report_to, stage, stage_ids, run_stage
 
 ###### Helper functions
 
-def gauss_smoothing(data, winwidth):
-    # Gaussian smoothing of EDA data
+# file extensions of the output formats for the result tables, hdf5 tables are 
+# all saved in one store per output directory and memmap tables consist of a 
+# .json header and a .dat file with the raw arrays
+out_exts   = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather', 'hdf5': '.h5', 'memmap': '.json'}
+store_name = 'preproPSYPHY.h5'
+
+@contextmanager
+def lock_store(fl, shared = False):
+    # locking the hdf5 store so that several worker processes can append to it 
+    # and read from it, no locking is possible on systems without fcntl. POSIX 
+    # record locks (lockf) are used since, unlike flock, they are passed on to 
+    # the server on NFS
+    
+    if fcntl is None:
+        yield
+        return
+    with open(fl + '.lock', 'a+') as fl_lock:
+        fcntl.lockf(fl_lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(fl_lock, fcntl.LOCK_UN)
+
+def write_table(df, dir_out, part, key, name, out_format = 'csv'):
+    # writing a result table including its index either as file dir_out/part_key_name 
+    # or into the hdf5 store of dir_out under /name/part/key. Parquet, feather and 
+    # hdf5 keep the column types, also of timedelta indices, and are compressed, 
+    # memmap saves uncompressed raw arrays that can be memory mapped
     
-    # pad to remove border errors
-    fdata = pd.concat([pd.Series(data.iloc[0]), data, pd.Series(data.iloc[-1])])
+    fl = os.path.join(dir_out, part + '_' + key + '_' + name)
+    # the attrs, e.g. the sample clock, are not saved: parquet and feather 
+    # serialise them as JSON which fails for the clock, the data is not copied
+    df = df.copy(deep = False)
+    df.attrs = {}
+    with stage('write', part, key, len(df), table = name):
+        if out_format == 'csv':
+            df.to_csv(fl + '.csv', index = True)
+        elif out_format == 'parquet':
+            df.to_parquet(fl + '.parquet', compression = 'zstd', index = True)
+        elif out_format == 'feather':
+            # feather cannot store an index, therefore it is saved as first column
+            df.reset_index().to_feather(fl + '.feather', compression = 'zstd')
+        elif out_format == 'hdf5':
+            fl = os.path.join(dir_out, store_name)
+            with lock_store(fl):
+                with pd.HDFStore(fl, mode = 'a', complevel = 5, complib = 'blosc:zstd') as store:
+                    store.put('/'.join(['', name, part, key]), df, format = 'fixed')
+        elif out_format == 'memmap':
+            write_memmap(df, fl)
+        else:
+            raise ValueError('out_format has to be csv, parquet, feather, hdf5 or memmap, not ' + str(out_format))
+
+def read_table(dir_out, part, key, name, out_format = 'csv', start = None, stop = None):
+    # reading a result table written by write_table, optionally only the rows 
+    # from start to stop which are read directly from the hdf5 store
+    
+    fl = os.path.join(dir_out, part + '_' + key + '_' + name)
+    if out_format == 'csv':
+        df = pd.read_csv(fl + '.csv', index_col = 0)
+    elif out_format == 'parquet':
+        df = pd.read_parquet(fl + '.parquet')
+    elif out_format == 'feather':
+        df = pd.read_feather(fl + '.feather')
+        df = df.set_index(df.columns[0]).rename_axis(None if df.columns[0] == 'index' else df.columns[0])
+    elif out_format == 'hdf5':
+        fl = os.path.join(dir_out, store_name)
+        with lock_store(fl, shared = True):
+            with pd.HDFStore(fl, mode = 'r') as store:
+                return store.select('/'.join(['', name, part, key]), start = start, stop = stop)
+    elif out_format == 'memmap':
+        df = read_memmap(fl)
+    else:
+        raise ValueError('out_format has to be csv, parquet, feather, hdf5 or memmap, not ' + str(out_format))
+    
+    return df.iloc[start:stop]
+
+def table_exists(dir_out, part, key, name, out_format = 'csv'):
+    # checking whether a result table was written
+    
+    if out_format == 'hdf5':
+        fl = os.path.join(dir_out, store_name)
+        if not os.path.exists(fl):
+            return False
+        with lock_store(fl, shared = True):
+            with pd.HDFStore(fl, mode = 'r') as store:
+                return '/'.join(['', name, part, key]) in store
+    
+    return os.path.exists(os.path.join(dir_out, part + '_' + key + '_' + name + out_exts[out_format]))
+
+def compact_store(dir_out, max_waste = 0.5):
+    # rewriting the hdf5 store of dir_out if more than max_waste of the file is 
+    # unused. Tables that are written again, e.g. when a block is rerun, leave 
+    # their old space behind since hdf5 never gives it back, the same as 
+    # running ptrepack on the store
+    
+    fl = os.path.join(dir_out, store_name)
+    if not os.path.exists(fl):
+        return
+    with lock_store(fl):
+        with pd.HDFStore(fl, mode = 'r') as store:
+            size = sum([node.size_on_disk for node in store._handle.walk_nodes('/', 'Leaf')])
+            if os.path.getsize(fl) <= (1 + max_waste)*size:
+                return
+            store.copy(fl + '.tmp', mode = 'w', complevel = 5, complib = 'blosc:zstd')
+        os.replace(fl + '.tmp', fl)
+
+def list_tables(dir_out):
+    # listing all tables in the hdf5 store of dir_out as (name, part, block)
+    
+    fl = os.path.join(dir_out, store_name)
+    with lock_store(fl, shared = True):
+        with pd.HDFStore(fl, mode = 'r') as store:
+            return [tuple(path.split('/')[1:]) for path in store.keys()]
+
+# with the method 'auto', gauss_smoothing uses overlap-add FFT for Gaussian 
+# windows of at least gauss_direct_width samples on signals of at least 
+# gauss_fft_length samples and convolves directly otherwise
+gauss_direct_width = 256
+gauss_fft_length   = 8192
+
+def gauss_smoothing(data, winwidth, method = 'direct'):
+    # Gaussian smoothing of EDA data. The data is extended at both ends by 
+    # repeating its first and last value. 'direct' gives the same values as the 
+    # original pandas implementation to the last bit, 'fft' is faster for wide 
+    # windows but differs in the last digits, 'auto' chooses based on winwidth 
+    # and the length of the data and is therefore not bit-exact either
     
     # ensure an even window width
     winwidth = math.floor(winwidth/2)*2
     
     # extend data to reduce convolution error at beginning and end
-    data_ext = pd.concat([pd.Series([fdata.iloc[0]]*int(winwidth/2)), fdata, pd.Series([fdata.iloc[-1]]*int(winwidth/2))])
+    data_ext = np.pad(np.asarray(data, dtype = float), int(winwidth/2), mode = 'edge')
     
     # apply normpdf (?)
-    x = np.array(range(1, winwidth+2))
+    x = np.arange(1, winwidth+2)
     mu = winwidth/2+1
     sigma = winwidth/8
     window = np.exp(-0.5 * ((x - mu)/sigma)**2) / (math.sqrt(2*math.pi) * sigma)
     window = window / sum(window)
     
-    # perform convolution for smoothing
-    sdata_ext = np.convolve(data_ext, window)
+    # perform convolution for smoothing, only where window and data fully overlap
+    if method == 'auto':
+        method = 'fft' if winwidth >= gauss_direct_width and len(data_ext) >= gauss_fft_length else 'direct'
+    if method == 'direct':
+        return np.convolve(data_ext, window, mode = 'valid')
+    elif method == 'fft':
+        return scipy.signal.oaconvolve(data_ext, window, mode = 'valid')
+    else:
+        raise ValueError("method must be 'auto', 'direct' or 'fft', not " + repr(method))
+
+def fill_missing(df, cols, method = 'linear'):
+    # filling the NaN runs of all columns cols of df at once, either linearly 
+    # or with a cubic Hermite curve which only depends on the two samples on 
+    # either side of each gap. Leading and trailing NaNs are filled with the 
+    # first and last valid value of each column. The linear fill gives the 
+    # same values as pandas' interpolate followed by bfill
+    
+    values  = df[cols].to_numpy(dtype = float)
+    missing = np.isnan(values)
+    if not missing.any():
+        return df
+    
+    # previous and next valid sample of every sample, -1 and n if there is none
+    n     = len(values)
+    pos   = np.arange(n)[:, np.newaxis]
+    left  = np.maximum.accumulate(np.where(missing, -1, pos), axis = 0)
+    right = np.minimum.accumulate(np.where(missing, n, pos)[::-1], axis = 0)[::-1]
+    
+    # only the missing samples are filled
+    rows, icols = np.nonzero(missing)
+    l  = left[rows, icols]
+    r  = right[rows, icols]
+    y0 = values[np.maximum(l, 0), icols]
+    y1 = values[np.minimum(r, n-1), icols]
+    filled = np.where(l < 0, y1, y0)
     
-    # cut to length of data
-    return sdata_ext[(1+winwidth):(len(sdata_ext)-winwidth-1)]
+    # gaps with valid samples on both sides
+    inner  = (l >= 0) & (r < n)
+    x      = rows[inner].astype(float)
+    x0     = l[inner].astype(float)
+    x1     = r[inner].astype(float)
+    y0     = y0[inner]
+    y1     = y1[inner]
+    slope  = (y1 - y0)/(x1 - x0)
+    if method == 'linear':
+        filled[inner] = slope*(x - x0) + y0
+    elif method == 'cubic':
+        # slopes at the borders of the gap from the neighbouring samples or, if 
+        # these are missing as well, the slope across the gap
+        icol = icols[inner]
+        prev = l[inner] - 1
+        nxt  = r[inner] + 1
+        m0   = y0 - values[np.maximum(prev, 0), icol]
+        m1   = values[np.minimum(nxt, n-1), icol] - y1
+        m0   = np.where((prev >= 0) & ~np.isnan(m0), m0, slope)
+        m1   = np.where((nxt < n) & ~np.isnan(m1), m1, slope)
+        h    = x1 - x0
+        t    = (x - x0)/h
+        filled[inner] = (2*t**3 - 3*t**2 + 1)*y0 + (t**3 - 2*t**2 + t)*h*m0 + (3*t**2 - 2*t**3)*y1 + (t**3 - t**2)*h*m1
+    else:
+        raise ValueError("method must be 'linear' or 'cubic', not " + repr(method))
+    values[rows, icols] = filled
+    
+    # write back, keeping the data type of float columns
+    for i, col in enumerate(cols):
+        df[col] = values[:, i].astype(df[col].dtype) if df[col].dtype.kind == 'f' else values[:, i]
+    
+    return df
 
 def int_missing(df_eda, df_bvp, df_temp, df_acc, f):
     # performing linear interpolation for bvp, temp and acc as well as cubic
-    # spline interpolation for eda
+    # interpolation for eda, all columns of a sensor are filled at once
     
     # only process temp if it is not empty
     if len(df_temp) > 0:
-        df_temp['temp'] = df_temp['temp'].interpolate()
-        df_temp['temp'] = df_temp['temp'].bfill()
+        df_temp = fill_missing(df_temp, ['temp'])
     
     # only process acc if it is not empty
     if len(df_acc) > 0:
-        df_acc['accx'] = df_acc['accx'].interpolate()
-        df_acc['accx'] = df_acc['accx'].bfill()
-        df_acc['accy'] = df_acc['accy'].interpolate()
-        df_acc['accy'] = df_acc['accy'].bfill()
-        df_acc['accz'] = df_acc['accz'].interpolate()
-        df_acc['accz'] = df_acc['accz'].bfill()
+        df_acc = fill_missing(df_acc, ['accx', 'accy', 'accz'])
         
     # EDA
     # first, if there is no raw column yet, then save the EDA as raw
@@ -103,8 +323,7 @@ def int_missing(df_eda, df_bvp, df_temp, df_acc, f):
         # if it already exists, just add it together to track interpolated values
         df_eda['interpolated'] = df_eda['interpolated'] + df_eda['eda'].isna()
     per_eda = np.mean(df_eda['eda'].isna())
-    df_eda['eda'] = df_eda['eda'].interpolate(method='spline', order=3)
-    df_eda['eda'] = df_eda['eda'].bfill()
+    df_eda = fill_missing(df_eda, ['eda'], 'cubic')
     
     # BVP
     # first, if there is no raw column yet, then save the BVP as raw
@@ -118,8 +337,7 @@ def int_missing(df_eda, df_bvp, df_temp, df_acc, f):
         # if it already exists, just add it together to track interpolated values
         df_bvp['interpolated'] = df_bvp['interpolated'] + df_bvp['bvp'].isna()
     per_bvp = np.mean(df_bvp['bvp'].isna())
-    df_bvp['bvp'] = df_bvp['bvp'].interpolate()
-    df_bvp['bvp'] = df_bvp['bvp'].bfill()
+    df_bvp = fill_missing(df_bvp, ['bvp'])
     
     # print how much was interpolated for bvp and eda
     if round(per_eda, 2) == round(per_bvp, 2):
@@ -144,86 +362,104 @@ def int_missing(df_eda, df_bvp, df_temp, df_acc, f):
     return df_eda, df_bvp, df_temp, df_acc
 
 def na_missing(df_eda, df_bvp, labels):
-    # taking the labels from the artefact detection classifier and create column
-    # with NaNs where artefacts were detected
-    
-    # join label dataframes with the dataframes containing EDA and BVP
-    labels.index = labels['StartTime']
-    df_eda = df_eda.join(labels, how='outer')
-    df_bvp = df_bvp.join(labels, how='outer')
+    # taking the labels from the artefact detection classifier and setting all 
+    # samples of epochs which are not labelled as okay to NaN. Each epoch covers 
+    # the samples from its start time up to the start time of the next epoch, 
+    # samples before the first epoch are set to NaN as well
     
-    # fill up the NaNs with the preceeding label
-    df_eda['Binary'] = df_eda['Binary'].fillna(method='ffill')
-    df_bvp['Binary'] = df_bvp['Binary'].fillna(method='ffill')
+    starts = pd.to_timedelta(labels['StartTime']).to_numpy().astype('timedelta64[ns]')
+    binary = labels['Binary'].to_numpy(dtype = float)
     
-    # calculate the new column and drop the unnecessary ones
-    df_eda['eda'] = np.where(df_eda['Binary'] == 1, df_eda['eda'], np.nan)
-    df_bvp['bvp'] = np.where(df_bvp['Binary'] == 1, df_bvp['bvp'], np.nan)
-    df_eda = df_eda.drop(columns=['StartTime', 'EndTime'])
-    df_bvp = df_bvp.drop(columns=['StartTime', 'EndTime'])
+    ls_df = []
+    for df, col in [(df_eda, 'eda'), (df_bvp, 'bvp')]:
+        df = df.copy()
+        
+        # first sample of each epoch and number of samples per epoch
+        first  = find_rows(df, pd.to_timedelta(starts))
+        counts = np.diff(np.append(first, len(df)))
+        
+        # label of each sample and NaNs wherever the label is not okay
+        df['Binary'] = np.concatenate([np.full(first[0] if len(first) > 0 else len(df), np.nan), np.repeat(binary, counts)])
+        values = df[col].to_numpy(dtype = float, copy = True)
+        values[df['Binary'].to_numpy() != 1] = np.nan
+        df[col] = values
+        ls_df.append(df)
     
-    return df_eda, df_bvp
+    return ls_df[0], ls_df[1]
 
 ###### Cut and convert the data
 
+def read_avro_record(filepath):
+    # reading in the raw data of the last record of an avro file, either with the 
+    # compiled decoder of the fastavro package or with the reference avro package
+    
+    if fastavro is not None:
+        with open(filepath, "rb") as fo:
+            for user in fastavro.reader(fo):
+                dict_data = user
+    else:
+        reader = DataFileReader(open(filepath, "rb"), DatumReader())
+        for user in reader:
+            dict_data = user
+        reader.close()
+    
+    return dict_data['rawData']
+
 def read_avro(filepath):
     # reading in avro data and converting it into data frames with the correct time stamp
     
     # read in the avro data
-    reader = DataFileReader(open(filepath, "rb"), DatumReader())
-    for user in reader:
-        dict_data = user
-    reader.close()
+    rawData = read_avro_record(filepath)
     
     # temperature: 
-    startTime = datetime.fromtimestamp((float(dict_data['rawData']['temperature']['timestampStart'])/(10**(len(str(dict_data['rawData']['temperature']['timestampStart']))-10)))) #1000000
-    sampRate  = dict_data['rawData']['temperature']['samplingFrequency']
-    df_temp   = pd.DataFrame(dict_data['rawData']['temperature']['values'], columns=["temp"])
+    startTime = datetime.fromtimestamp((float(rawData['temperature']['timestampStart'])/(10**(len(str(rawData['temperature']['timestampStart']))-10)))) #1000000
+    sampRate  = rawData['temperature']['samplingFrequency']
+    df_temp   = pd.DataFrame({'temp': np.asarray(rawData['temperature']['values'], dtype=float)})
     if sampRate > 0.0:
-        freq      = str(round(1/sampRate)) + 'S'
-        time      = pd.date_range(startTime, periods=len(df_temp), freq=freq)
-        df_temp.index = time
+        clock     = SampleClock.from_rate(startTime, sampRate)
+        df_temp.index = clock.index(len(df_temp))
+        set_clock(df_temp, clock)
         df_temp['sampRate'] = round(1/sampRate)
     
     # acceleration
-    startTime = datetime.fromtimestamp((float(dict_data['rawData']['accelerometer']['timestampStart'])/(10**(len(str(dict_data['rawData']['accelerometer']['timestampStart']))-10))))
-    sampRate  = dict_data['rawData']['accelerometer']['samplingFrequency']
-    df_acc    = pd.DataFrame({'accx_raw': dict_data['rawData']['accelerometer']['x'],
-                              'accy_raw': dict_data['rawData']['accelerometer']['y'],
-                              'accz_raw': dict_data['rawData']['accelerometer']['z']})
+    startTime = datetime.fromtimestamp((float(rawData['accelerometer']['timestampStart'])/(10**(len(str(rawData['accelerometer']['timestampStart']))-10))))
+    sampRate  = rawData['accelerometer']['samplingFrequency']
+    df_acc    = pd.DataFrame({'accx_raw': np.asarray(rawData['accelerometer']['x'], dtype=np.int64),
+                              'accy_raw': np.asarray(rawData['accelerometer']['y'], dtype=np.int64),
+                              'accz_raw': np.asarray(rawData['accelerometer']['z'], dtype=np.int64)})
     if sampRate > 0.0:
-        freq      = str(round(1/sampRate, 6)) + 'S'
-        time      = pd.date_range(startTime, periods=len(df_acc), freq=freq)
-        df_acc.index = time
+        clock     = SampleClock.from_rate(startTime, sampRate)
+        df_acc.index = clock.index(len(df_acc))
+        set_clock(df_acc, clock)
         df_acc['sampRate'] = round(1/sampRate, 6)
     
     # bvp
-    startTime = datetime.fromtimestamp((float(dict_data['rawData']['bvp']['timestampStart'])/(10**(len(str(dict_data['rawData']['bvp']['timestampStart']))-10))))
-    sampRate  = dict_data['rawData']['bvp']['samplingFrequency']
-    df_bvp    = pd.DataFrame({'bvp': dict_data['rawData']['bvp']['values']})
+    startTime = datetime.fromtimestamp((float(rawData['bvp']['timestampStart'])/(10**(len(str(rawData['bvp']['timestampStart']))-10))))
+    sampRate  = rawData['bvp']['samplingFrequency']
+    df_bvp    = pd.DataFrame({'bvp': np.asarray(rawData['bvp']['values'], dtype=float)})
     if sampRate > 0.0:
-        freq      = str(round(1/sampRate, 6)) + 'S'
-        time      = pd.date_range(startTime, periods=len(df_bvp), freq=freq)
-        df_bvp.index = time
+        clock     = SampleClock.from_rate(startTime, sampRate)
+        df_bvp.index = clock.index(len(df_bvp))
+        set_clock(df_bvp, clock)
         df_bvp['sampRate'] = round(1/sampRate, 6)
         
     # eda
-    startTime = datetime.fromtimestamp((float(dict_data['rawData']['eda']['timestampStart'])/(10**(len(str(dict_data['rawData']['eda']['timestampStart']))-10))))
-    sampRate  = dict_data['rawData']['eda']['samplingFrequency']
-    df_eda    = pd.DataFrame({'eda': dict_data['rawData']['eda']['values']})
+    startTime = datetime.fromtimestamp((float(rawData['eda']['timestampStart'])/(10**(len(str(rawData['eda']['timestampStart']))-10))))
+    sampRate  = rawData['eda']['samplingFrequency']
+    df_eda    = pd.DataFrame({'eda': np.asarray(rawData['eda']['values'], dtype=float)})
     if sampRate > 0.0:
-        freq      = str(round(1/sampRate, 2)) + 'S'
-        time      = pd.date_range(startTime, periods=len(df_eda), freq=freq)
-        df_eda.index = time
+        clock     = SampleClock.from_rate(startTime, sampRate)
+        df_eda.index = clock.index(len(df_eda))
+        set_clock(df_eda, clock)
         df_eda['sampRate'] = round(1/sampRate, 2)
     
     # return all data frames
     return df_temp, df_acc, df_bvp, df_eda
 
-def convert_eplus(dir_path, part, f):
-    # reading in and converting data collected with Embrace Plus
+def find_avro(dir_path, part):
+    # finding the avro files of a participant up to six levels below the input 
+    # directory, returns them sorted by their start time in unix
     
-    # find the path to the participant
     sub_path = dir_path
     for i in range(6):
         # get list of all files of this participant
@@ -234,76 +470,133 @@ def convert_eplus(dir_path, part, f):
         else: 
             sub_path = sub_path + '/*'
     
+    # sort by start time in unix
+    return sorted(fls, key=lambda i: int(os.path.splitext(os.path.basename(i))[0][-9:]))
+
+def merge_chunks(ls_df):
+    # merging the data frames of consecutive avro files of one sensor into one 
+    # data frame, the time between two files is filled with NaNs at the sampling 
+    # rate of the sensor: temp 1Hz, acc and bvp 64Hz, eda 4Hz. The sizes of all 
+    # files and gaps are determined first so that every column is written into 
+    # one preallocated array instead of concatenating the files pairwise
+    
+    # files without any samples are skipped
+    ls_df = [df for df in ls_df if len(df) > 0]
+    if len(ls_df) == 0:
+        return pd.DataFrame()
+    
+    # number of missing samples between the end of the previous and the start of the current file
+    # as (clock starting at the last sample of the previous file, number of samples), 
+    # the gap ends at least one sampling period before the start of the current file
+    ls_gap = [(None, 0)]
+    for df_prev, df in zip(ls_df[:-1], ls_df[1:]):
+        clock = get_clock(df_prev)
+        if clock is not None:
+            clock = clock.shift(len(df_prev) - 1)
+        elif 'sampRate' in df.columns:
+            clock = SampleClock(df_prev.index[-1], Fraction(repr(df['sampRate'].iloc[0])))
+        if clock is not None:
+            ls_gap.append((clock, max(0, clock.sample(df.index[0], side = 'right') - 2)))
+        else:
+            ls_gap.append((None, 0))
+    n_gap = sum([gap[1] for gap in ls_gap])
+    n_all = n_gap + sum([len(df) for df in ls_df])
+    
+    # preallocate the index and the columns, integer columns become float if NaNs are inserted
+    index   = np.empty(n_all, dtype=np.int64)
+    columns = ls_df[0].columns
+    values  = {}
+    for col in columns:
+        dtype = ls_df[0][col].dtype
+        if n_gap > 0 and not np.issubdtype(dtype, np.floating):
+            dtype = np.float64
+        values[col] = np.full(n_all, np.nan, dtype=dtype) if n_gap > 0 else np.empty(n_all, dtype=dtype)
+    
+    # write the gaps and the files into the arrays, the merged data frame keeps 
+    # the clock of the first file if all files lie on it. The sampling rate is 
+    # constant per sensor, so the gaps get the one of the previous file
+    pos   = 0
+    clock = get_clock(ls_df[0])
+    for df_prev, gap, df in zip([None] + ls_df[:-1], ls_gap, ls_df):
+        if gap[1] > 0:
+            index[pos:pos+gap[1]] = gap[0].index(gap[1], first = 1).asi8
+            if 'sampRate' in columns:
+                values['sampRate'][pos:pos+gap[1]] = df_prev['sampRate'].iloc[-1]
+            pos = pos + gap[1]
+        index[pos:pos+len(df)] = df.index.asi8
+        if clock is not None and (get_clock(df) is None or clock.time(pos) != df.index[0] or get_clock(df).period != clock.period):
+            clock = None
+        for col in columns:
+            values[col][pos:pos+len(df)] = df[col].to_numpy()
+        pos = pos + len(df)
+    
+    df_merged = pd.DataFrame(values, index=pd.DatetimeIndex(index.view('datetime64[ns]')), columns=columns)
+    if clock is not None:
+        set_clock(df_merged, clock)
+    
+    return df_merged
+
+def convert_eplus(dir_path, part, f, n_jobs_avro = 1):
+    # reading in and converting data collected with Embrace Plus, the avro files
+    # can be decoded in parallel by n_jobs_avro worker processes
+    
+    # find the avro files of the participant
+    fls = find_avro(dir_path, part)
+    
     # check if any data was found
     if len(fls) < 1:
         print(simple_colors.red(datetime.now().strftime("%H:%M:%S") + '- no data was found for participant ' + part, 'bold'))
         f.write('\n' + datetime.now().strftime("%H:%M:%S") + '- no data was found for participant ' + part)
         return {}
     
-    # sort by start time in unix
-    fls = sorted(fls, key=lambda i: int(os.path.splitext(os.path.basename(i))[0][-9:]))
+    # read in the avro data, the files are independent of each other and the 
+    # results are returned in the order of the sorted files
+    if n_jobs_avro > 1:
+        with ProcessPoolExecutor(max_workers = n_jobs_avro) as pool:
+            ls_data = list(pool.map(read_avro, fls))
+    else:
+        ls_data = list(map(read_avro, fls))
     
-    # initialise empty data frames
-    ls_temp = list()
-    ls_acc  = list()
-    ls_eda  = list()
-    ls_bvp  = list()
+    # merge the files of each sensor into one data frame
+    dict_data = {
+        'temp' : merge_chunks([data[0] for data in ls_data]),
+        'acc'  : merge_chunks([data[1] for data in ls_data]),
+        'bvp'  : merge_chunks([data[2] for data in ls_data]),
+        'eda'  : merge_chunks([data[3] for data in ls_data])
+        }
     
-    # loop through files
-    for fl in fls:
-        # read in the avro data
-        df_temp, df_acc, df_bvp, df_eda = read_avro(fl)
-        # check timing difference: 
-        if len(ls_temp) > 0 & len(df_temp) > 0: 
-            # temperature: 1Hz -> should be about 1 per second
-            idx_temp = pd.date_range(ls_temp[-1].index[-1]+pd.Timedelta(seconds=df_temp['sampRate'].iloc[0]), 
-                                     df_temp.index[0]-pd.Timedelta(seconds=df_temp['sampRate'].iloc[0]), freq=str(df_temp['sampRate'].iloc[0])+'S')
-            tdf_temp = pd.DataFrame(np.nan, index=idx_temp, columns=['temp'])
-            df_temp  = pd.concat([tdf_temp, df_temp])
-        
-        if len(ls_acc) > 0 & len(df_acc) > 0: 
-            # acceleration: 64Hz -> should be about 1 every 15.625ms
-            idx_acc  = pd.date_range(ls_acc[-1].index[-1]+pd.Timedelta(seconds=df_acc['sampRate'].iloc[0]), 
-                                     df_acc.index[0]-pd.Timedelta(seconds=df_acc['sampRate'].iloc[0]), freq=str(df_acc['sampRate'].iloc[0])+'S')
-            tdf_acc  = pd.DataFrame(np.nan, index=idx_acc, columns=['accx', 'accy', 'accz'])
-            df_acc   = pd.concat([tdf_acc, df_acc])
-        
-        if len(ls_eda) > 0 & len(df_eda) > 0:     
-            # eda: 4Hz -> should be about 1 every 250ms
-            idx_eda  = pd.date_range(ls_eda[-1].index[-1]+pd.Timedelta(seconds=df_eda['sampRate'].iloc[0]), 
-                                     df_eda.index[0]-pd.Timedelta(seconds=df_eda['sampRate'].iloc[0]), freq=str(df_eda['sampRate'].iloc[0])+'S')
-            tdf_eda  = pd.DataFrame(np.nan, index=idx_eda, columns=['eda'])
-            df_eda   = pd.concat([tdf_eda, df_eda])
-        
-        if len(ls_bvp) > 0 & len(df_bvp) > 0:     
-            # bvp: 1Hz -> 64Hz -> should be about 1 every 15.625ms
-            idx_bvp = pd.date_range(ls_bvp[-1].index[-1]+pd.Timedelta(seconds=df_bvp['sampRate'].iloc[0]), 
-                                     df_bvp.index[0]-pd.Timedelta(seconds=df_bvp['sampRate'].iloc[0]), freq=str(df_bvp['sampRate'].iloc[0])+'S')
-            tdf_bvp  = pd.DataFrame(np.nan, index=idx_bvp, columns=['bvp'])
-            df_bvp   = pd.concat([tdf_bvp, df_bvp])
-            
-        # append to lists
-        if len(df_bvp) > 0:
-            ls_bvp.append(df_bvp)
-        if len(df_temp) > 0:
-            ls_temp.append(df_temp)
-        if len(df_acc) > 0:
-            # scale the accelometer to +-2g: "each ADC count will be = 1/2048g" (email from 12.12.2023)
-            df_acc["accx"] = df_acc["accx_raw"]/2048
-            df_acc["accy"] = df_acc["accy_raw"]/2048
-            df_acc["accz"] = df_acc["accz_raw"]/2048
-            
-            ls_acc.append(df_acc)
-        if len(df_eda) > 0:
-            ls_eda.append(df_eda)
-    
-    # concat list of dataframes to dataframes in dictionary
-    return {
-        'temp' : pd.concat(ls_temp),
-        'acc'  : pd.concat(ls_acc),
-        'bvp'  : pd.concat(ls_bvp),
-        'eda'  : pd.concat(ls_eda)
-    }
+    # scale the accelometer to +-2g: "each ADC count will be = 1/2048g" (email from 12.12.2023)
+    if len(dict_data['acc']) > 0:
+        dict_data['acc']["accx"] = dict_data['acc']["accx_raw"]/2048
+        dict_data['acc']["accy"] = dict_data['acc']["accy_raw"]/2048
+        dict_data['acc']["accz"] = dict_data['acc']["accz_raw"]/2048
+    
+    return dict_data
+
+def read_e4(fl, names, digits, dtype = np.float64):
+    # reading an E4 csv file. The first line holds the start time as unix time 
+    # stamp and the second line the sampling rate, both are read directly, the 
+    # remaining lines are parsed as one block of the given type, with pyarrow 
+    # if available. The time index is computed by the sample clock, the column 
+    # sampRate holds the sampling period rounded to digits
+    
+    with open(fl) as fl_csv:
+        startTime = pd.to_datetime(float(fl_csv.readline().split(',')[0]), unit="s")
+        sampRate  = float(fl_csv.readline().split(',')[0])
+    
+    if pa_csv is not None:
+        table = pa_csv.read_csv(fl, read_options = pa_csv.ReadOptions(skip_rows = 2, column_names = names), 
+                                convert_options = pa_csv.ConvertOptions(column_types = {name: pyarrow.from_numpy_dtype(dtype) for name in names}))
+        df = table.to_pandas()
+    else:
+        df = pd.read_csv(fl, names = names, header = None, skiprows = 2, dtype = dtype)
+    
+    clock = SampleClock.from_rate(startTime, sampRate)
+    df.index = clock.index(len(df))
+    df['sampRate'] = round(1/sampRate, digits)
+    set_clock(df, clock)
+    
+    return df
 
 def convert_e4(part_path, part, f):
     # reading in all e4 data and adding a time index
@@ -319,48 +612,20 @@ def convert_e4(part_path, part, f):
         return {}
     
     # temperature
-    df_temp   = pd.read_csv(os.path.join(part_path, 'TEMP.csv'), names=['temp'], header=None)
-    startTime = pd.to_datetime(float(df_temp.iloc[0,0]), unit="s")
-    sampRate  = float(df_temp.iloc[1,0])
-    freq      = str(round(1/sampRate, 3)) + 'S'
-    df_temp   = df_temp[df_temp.index>1]
-    time      = pd.date_range(startTime, periods=len(df_temp), freq=freq)
-    df_temp.index = time
-    df_temp['sampRate'] = round(1/sampRate, 3)
+    df_temp = read_e4(fl_temp[0], ['temp'], 3)
     
-    # acceleration
-    df_acc    = pd.read_csv(os.path.join(part_path, 'ACC.csv'), names=['accx_raw', 'accy_raw', 'accz_raw'], header=None)
-    startTime = pd.to_datetime(float(df_acc.iloc[0,0]), unit="s")
-    sampRate  = float(df_acc.iloc[1,0])
-    freq      = str(round(1/sampRate, 6)) + 'S'
-    df_acc    = df_acc[df_acc.index>1]
-    time      = pd.date_range(startTime, periods=len(df_acc), freq=freq)
-    df_acc.index = time
-    df_acc['sampRate'] = round(1/sampRate, 6)
+    # acceleration, the raw values are integers which are exact in float32
+    df_acc  = read_e4(fl_acc[0], ['accx_raw', 'accy_raw', 'accz_raw'], 6, np.float32)
     # scale the accelometer to +-2g: "a value of x = 64 is in practice 1g"
     df_acc["accx"] = df_acc["accx_raw"]/64
     df_acc["accy"] = df_acc["accy_raw"]/64
     df_acc["accz"] = df_acc["accz_raw"]/64
     
     # eda
-    df_eda    = pd.read_csv(os.path.join(part_path, 'EDA.csv'), names=['eda'], header=None)
-    startTime = pd.to_datetime(float(df_eda.iloc[0,0]), unit="s")
-    sampRate  = float(df_eda.iloc[1,0])
-    freq      = str(round(1/sampRate, 3)) + 'S'
-    df_eda    = df_eda[df_eda.index>1]
-    time      = pd.date_range(startTime, periods=len(df_eda), freq=freq)
-    df_eda.index = time
-    df_eda['sampRate'] = round(1/sampRate, 3)
+    df_eda  = read_e4(fl_eda[0], ['eda'], 3)
     
     # bvp
-    df_bvp    = pd.read_csv(os.path.join(part_path, 'BVP.csv'), names=['bvp'], header=None)
-    startTime = pd.to_datetime(float(df_bvp.iloc[0,0]), unit="s")
-    sampRate  = float(df_bvp.iloc[1,0])
-    freq      = str(round(1/sampRate, 6)) + 'S'
-    df_bvp    = df_bvp[df_bvp.index>1]
-    time      = pd.date_range(startTime, periods=len(df_bvp), freq=freq)
-    df_bvp.index = time
-    df_bvp['sampRate'] = round(1/sampRate, 6)
+    df_bvp  = read_e4(fl_bvp[0], ['bvp'], 6)
     
     # put all data frames into one dictionary and return it
     return {       
@@ -406,104 +671,148 @@ def convert_cut(dir_path, part, f):
         'eda'  : df_eda
     }
 
+def find_rows(df, times):
+    # first row of a data frame at or after each of the times, computed from 
+    # its sample clock if it has one or else by searching its sorted index
+    
+    clock = get_clock(df)
+    if clock is None:
+        return df.index.searchsorted(times)
+    
+    return np.clip(clock.sample(times), 0, len(df))
+
+def reset_time(df):
+    # saving the time stamps in a column time and replacing the index with the 
+    # time since the first sample from the sample clock of the data frame or 
+    # its sampling period, the data itself is not copied
+    
+    clock = get_clock(df)
+    df = df.copy(deep = False)
+    df['time'] = df.index
+    if len(df) > 0:
+        if clock is None:
+            clock = SampleClock(pd.Timedelta(0), Fraction(repr(df['sampRate'].iloc[0])))
+        else:
+            clock = clock.rebase(pd.Timedelta(0))
+        df.index = clock.index(len(df))
+        set_clock(df, clock)
+    else:
+        df.index = pd.TimedeltaIndex([])
+    
+    return df
+
 def cut_data(dict_data, tags, dir_out, f):
-    # cutting the data into blocks of interest based on the tag files
+    # cutting the data into blocks of interest based on the tag files. First, 
+    # start and duration of all blocks are determined, then the rows of all 
+    # blocks of a signal are computed from its sample clock at once
     
     # if output directory does not exist, create it
     if not os.path.exists(dir_out): os.makedirs(dir_out) 
     
-    # create empty dictionary
-    dict_df_new = {}
+    # blocks as tag, start and duration in seconds, None for the whole recording
+    ls_blocks = []
+    idx_bvp   = dict_data['bvp'].index
         
     # loop throught the rows of tags
     for index, row in tags.iterrows():
         
         # check if anything is supposed to be cut
-        if row['start_unit'] != 'all':
+        if row['start_unit'] == 'all':
+            ls_blocks.append((row['tag'], None, None))
+            continue
         
-            # check if end and start values are provided
-            if np.isnan(row['end']) | np.isnan(row['start']):
-                print(simple_colors.red('Skipping block ' + row['tag'] + '.', 'bold'), 'Either start or end value is missing.')
-                f.write('\n' + 'Skipping block ' + row['tag'] + '. Either start or end value is missing.')
-                continue
-            
-            # determine the start point in seconds from the beginning of the recording
-            if row['start_unit'] == 'unix':
-                # rounded unix has to have 10 digits for it to be feasible (roughly between 2001 and 2286)
-                # however, sometimes saved in different unit, therefore, we adjust it
-                adjust = len(str(round(row['start']))) - 10
-                start   = datetime.utcfromtimestamp(float(row['start'])/(10**adjust))
-            elif row['start_unit'] == 'seconds':
-                start   = dict_data['bvp'].index[0] + pd.Timedelta(seconds=row['start'])
-            else:
-                print(simple_colors.red('Skipping block ' + row['tag'] + '.', 'bold'), 'Start of each tag has to be either seconds or unix.')
-                f.write('\n' + 'Skipping block ' + row['tag'] + '. Start of each tag has to be either seconds or unix.')
-                continue
-            
-            # add buffer if necessary
-            if row['start_buffer'] > 0:
-                start = start + pd.Timedelta(seconds=row['start_buffer'])
-            
-            # cut out start 
-            if len(dict_data['temp']) > 0:
-                df_temp = dict_data['temp'][dict_data['temp'].index >= start]
-            else:
-                df_temp = []
-            if len(dict_data['acc']) > 0:
-                df_acc  = dict_data['acc'][dict_data['acc'].index   >= start]
-            else:
-                df_acc = []
-            df_bvp  = dict_data['bvp'][dict_data['bvp'].index   >= start]
-            df_eda  = dict_data['eda'][dict_data['eda'].index   >= start]
-            
-            # figure out duration of block if not in seconds based on bvp
-            if row['end_unit'] == 'unix':
-                # rounded unix has to have 10 digits for it to be feasible (roughly between 2001 and 2286)
-                # however, sometimes saved in different unit, therefore, we adjust it
-                adjust = len(str(round(row['start']))) - 10
-                end   = (datetime.utcfromtimestamp(float(row['end'])/(10**adjust)) - df_bvp.index[0]).total_seconds()
-            elif row['end_unit'] == 'duration': 
-                end = row['end']
-            elif row['end_unit'] == 'seconds':
-                x = df_bvp.index[0] - dict_data['bvp'].index[0]
-                end = row['end'] - x.total_seconds()
-            else:
-                print(simple_colors.red('Skipping block ' + row['tag'] + '.', 'bold'), 'End of each tag has to be duration, seconds or unix.')
-                f.write('\n' + 'Skipping block ' + row['tag'] + '. End of each tag has to be duration, seconds or unix.')
-                continue
-            
-            # subtract buffer from end and check if enought time left
-            end = end - row['end_buffer']
-            if end <= 0:
-                print(simple_colors.red('Skipping block ' + row['tag'] + '.', 'bold'), 'Duration is 0 seconds or less.')
-                f.write('\n' + 'Skipping block ' + row['tag'] + '. Duration is 0 seconds or less.')
-                continue
+        # check if end and start values are provided
+        if np.isnan(row['end']) | np.isnan(row['start']):
+            print(simple_colors.red('Skipping block ' + row['tag'] + '.', 'bold'), 'Either start or end value is missing.')
+            f.write('\n' + 'Skipping block ' + row['tag'] + '. Either start or end value is missing.')
+            continue
+        
+        # determine the start point in seconds from the beginning of the recording
+        if row['start_unit'] == 'unix':
+            # rounded unix has to have 10 digits for it to be feasible (roughly between 2001 and 2286)
+            # however, sometimes saved in different unit, therefore, we adjust it
+            adjust = len(str(round(row['start']))) - 10
+            start   = pd.Timestamp(datetime.utcfromtimestamp(float(row['start'])/(10**adjust)))
+        elif row['start_unit'] == 'seconds':
+            start   = idx_bvp[0] + pd.Timedelta(seconds=row['start'])
+        else:
+            print(simple_colors.red('Skipping block ' + row['tag'] + '.', 'bold'), 'Start of each tag has to be either seconds or unix.')
+            f.write('\n' + 'Skipping block ' + row['tag'] + '. Start of each tag has to be either seconds or unix.')
+            continue
+        
+        # add buffer if necessary
+        if row['start_buffer'] > 0:
+            start = start + pd.Timedelta(seconds=row['start_buffer'])
+        
+        # first BVP sample of the block
+        i_bvp = find_rows(dict_data['bvp'], start)
+        if i_bvp == len(idx_bvp):
+            print(simple_colors.red('Skipping block ' + row['tag'] + '.', 'bold'), 'The recording ends before the start of the block.')
+            f.write('\n' + 'Skipping block ' + row['tag'] + '. The recording ends before the start of the block.')
+            continue
+        
+        # figure out duration of block if not in seconds based on bvp
+        if row['end_unit'] == 'unix':
+            # rounded unix has to have 10 digits for it to be feasible (roughly between 2001 and 2286)
+            # however, sometimes saved in different unit, therefore, we adjust it
+            adjust = len(str(round(row['start']))) - 10
+            end   = (datetime.utcfromtimestamp(float(row['end'])/(10**adjust)) - idx_bvp[i_bvp]).total_seconds()
+        elif row['end_unit'] == 'duration': 
+            end = row['end']
+        elif row['end_unit'] == 'seconds':
+            x = idx_bvp[i_bvp] - idx_bvp[0]
+            end = row['end'] - x.total_seconds()
+        else:
+            print(simple_colors.red('Skipping block ' + row['tag'] + '.', 'bold'), 'End of each tag has to be duration, seconds or unix.')
+            f.write('\n' + 'Skipping block ' + row['tag'] + '. End of each tag has to be duration, seconds or unix.')
+            continue
+        
+        # subtract buffer from end and check if enought time left
+        end = end - row['end_buffer']
+        if end <= 0:
+            print(simple_colors.red('Skipping block ' + row['tag'] + '.', 'bold'), 'Duration is 0 seconds or less.')
+            f.write('\n' + 'Skipping block ' + row['tag'] + '. Duration is 0 seconds or less.')
+            continue
+        
+        ls_blocks.append((row['tag'], start, end))
+    
+    # find the first and the last row of all blocks in each signal, a block 
+    # lasts from the first sample after its start for its duration
+    ls_cut  = [(tag, start, end) for tag, start, end in ls_blocks if start is not None]
+    dict_rows = {}
+    for sig in ['temp', 'acc', 'bvp', 'eda']:
+        if len(dict_data[sig]) == 0 or len(ls_cut) == 0:
+            continue
+        idx   = dict_data[sig].index
+        first = find_rows(dict_data[sig], pd.DatetimeIndex([start for _, start, _ in ls_cut]))
+        last  = find_rows(dict_data[sig], pd.DatetimeIndex([idx[min(i, len(idx)-1)] + pd.Timedelta(seconds=end) for i, (_, _, end) in zip(first, ls_cut)]))
+        dict_rows[sig] = (first, np.maximum(first, last))
+    
+    # create empty dictionary
+    dict_df_new = {}
+    
+    # cut out the blocks in the order of the tags
+    i_cut = 0
+    for tag, start, end in ls_blocks:
+        
+        if start is not None:
             
-            # cut out the end point as well as
-            if len(dict_data['temp']) > 0:
-                df_temp = df_temp[df_temp.index <
-                                        (df_temp.index[0] + pd.Timedelta(seconds=end))]
-                df_temp['time'] = df_temp.index
-                df_temp.index = pd.timedelta_range(start='0S', periods=len(df_temp), freq=str(df_temp['sampRate'].iloc[0]*1000000)+'U')
-            if len(dict_data['acc']) > 0:
-                df_acc  = df_acc[df_acc.index <
-                                        (df_acc.index[0] + pd.Timedelta(seconds=end))]
-                df_acc['time'] = df_acc.index
-                df_acc.index  = pd.timedelta_range(start='0S', periods=len(df_acc), freq=str(df_acc['sampRate'].iloc[0]*1000000)+'U')
-            df_eda  = df_eda[df_eda.index < 
-                                        (df_eda.index[0] + pd.Timedelta(seconds=end))]
-            df_eda['time'] = df_eda.index
-            df_eda.index  = pd.timedelta_range(start='0S', periods=len(df_eda), freq=str(df_eda['sampRate'].iloc[0]*1000000)+'U')
-            df_bvp  = df_bvp[df_bvp.index < 
-                                        (df_bvp.index[0] + pd.Timedelta(seconds=end))] 
-            df_bvp['time'] = df_bvp.index       
-            df_bvp.index  = pd.timedelta_range(start='0S', periods=len(df_bvp), freq=str(df_bvp['sampRate'].iloc[0]*1000000)+'U')
+            # rows of the block in each signal, the cut data frames are views
+            dict_block = {}
+            for sig in ['temp', 'acc', 'bvp', 'eda']:
+                if sig in dict_rows:
+                    first, last = dict_rows[sig]
+                    dict_block[sig] = reset_time(dict_data[sig].iloc[first[i_cut]:last[i_cut]])
+                else:
+                    dict_block[sig] = []
+            i_cut += 1
             
             # interpolate missing data and add column with interpolation info
-            df_eda, df_bvp, df_temp, df_acc = int_missing(df_eda, df_bvp, df_temp, df_acc, f)
+            with stage('int_missing', block = tag, samples = sum([len(df) for df in dict_block.values()])):
+                df_eda, df_bvp, df_temp, df_acc = int_missing(dict_block['eda'], dict_block['bvp'], dict_block['temp'], dict_block['acc'], f)
             
             # add cut data frame to the lists
-            dict_df_new[row['tag']] = {     
+            dict_df_new[tag] = {     
                 'temp' : df_temp,
                 'acc'  : df_acc,
                 'bvp'  : df_bvp,
@@ -511,28 +820,297 @@ def cut_data(dict_data, tags, dir_out, f):
                 }
             
         else:
-            # reset the index 
-            df_bvp = dict_data['bvp']
-            df_bvp['time'] = df_bvp.index
-            df_bvp.index  = pd.timedelta_range(start='0S', periods=len(df_bvp), freq=str(df_bvp['sampRate'].iloc[0]*1000000)+'U')
-            df_eda = dict_data['eda']
-            df_eda['time'] = df_eda.index
-            df_eda.index  = pd.timedelta_range(start='0S', periods=len(df_eda), freq=str(df_eda['sampRate'].iloc[0]*1000000)+'U')
-            
-            # then add all the data under this tag if all is selected
-            dict_df_new[row['tag']] = {     
+            # then add all the data under this tag if all is selected, 
+            # resetting the index of bvp and eda
+            dict_df_new[tag] = {     
                 'temp' : dict_data['temp'],
                 'acc'  : dict_data['acc'],
-                'bvp'  : df_bvp,
-                'eda'  : df_eda
+                'bvp'  : reset_time(dict_data['bvp']),
+                'eda'  : reset_time(dict_data['eda'])
                 }
             
     # replace the data frame in the dictionary with the list of data frames
     return dict_df_new
 
+###### Cache of the converted data
+
+# version of the converters, has to be increased whenever convert_eplus, 
+# convert_e4 or convert_cut change their output so old cache entries are not used
+convert_version = 3
+
+def cache_files(dir_path, part, empatica):
+    # listing the raw input files of a participant that the conversion depends on
+    
+    if empatica == 'e+':
+        return find_avro(dir_path, part)
+    elif empatica == 'e4':
+        return [os.path.join(dir_path, part, fl + '.csv') for fl in ['TEMP', 'ACC', 'EDA', 'BVP']]
+    elif empatica == 'cut':
+        return [os.path.join(dir_path, fl + '_' + part + '.csv') for fl in ['EDA', 'BVP']]
+    return []
+
+def cache_key(fls, empatica):
+    # hashing the paths, sizes and modification times of the input files together 
+    # with the device type and the converter version, any change leads to a new key
+    
+    ls_key = [empatica, convert_version]
+    for fl in fls:
+        if not os.path.exists(fl):
+            return None
+        stat = os.stat(fl)
+        ls_key.append([os.path.abspath(fl), stat.st_size, stat.st_mtime_ns])
+    
+    return hashlib.sha1(repr(ls_key).encode()).hexdigest()
+
+def write_cache(dict_data, dir_entry):
+    # saving the converted data frames of a participant as parquet files in the 
+    # directory dir_entry, together with a JSON header of the signals and their 
+    # clocks. Nothing is pickled, so loading an entry never executes code
+    
+    os.makedirs(dir_entry)
+    header = {}
+    for sig, df in dict_data.items():
+        if isinstance(df, list):
+            header[sig] = None
+            continue
+        clock = df.attrs.get('clock')
+        header[sig] = {'clock': clock.to_dict() if clock is not None else None}
+        # the clock is saved in the header, parquet can only save plain attrs
+        df = df.copy(deep = False)
+        df.attrs = {}
+        df.to_parquet(os.path.join(dir_entry, sig + '.parquet'), compression = 'zstd', index = True)
+    with open(os.path.join(dir_entry, 'header.json'), 'w') as fl_json:
+        json.dump(header, fl_json)
+
+def read_cache(dir_entry):
+    # reading the data frames of a participant written by write_cache
+    
+    with open(os.path.join(dir_entry, 'header.json')) as fl_json:
+        header = json.load(fl_json)
+    dict_data = {}
+    for sig, info in header.items():
+        if info is None:
+            dict_data[sig] = []
+            continue
+        dict_data[sig] = pd.read_parquet(os.path.join(dir_entry, sig + '.parquet'))
+        if info['clock'] is not None:
+            set_clock(dict_data[sig], SampleClock.from_dict(info['clock']))
+    
+    return dict_data
+
+def cache_entries(cache_dir):
+    # all complete cache entries, incomplete ones end with the process id
+    
+    return [fl for fl in glob.glob(os.path.join(cache_dir, '*_*_*')) if os.path.isdir(fl) and '.' not in os.path.basename(fl)]
+
+def clear_cache(cache_dir, part = None):
+    # removing all cache entries or only those of one participant
+    
+    for fl in cache_entries(cache_dir):
+        if part is None or os.path.basename(fl).rsplit('_', 2)[0] == part:
+            shutil.rmtree(fl, ignore_errors = True)
+
+def prune_cache(cache_dir, cache_size):
+    # removing the least recently used cache entries until the cache is no 
+    # larger than cache_size GB, entries are touched whenever they are loaded
+    
+    ls_entries = []
+    for fl in cache_entries(cache_dir):
+        try:
+            mtime = os.stat(fl).st_mtime
+            fl_size = sum([os.path.getsize(os.path.join(fl, name)) for name in os.listdir(fl)])
+        except FileNotFoundError:
+            continue
+        ls_entries.append((mtime, fl_size, fl))
+    
+    size = sum([entry[1] for entry in ls_entries])
+    for mtime, fl_size, fl in sorted(ls_entries):
+        if size <= cache_size*1024**3:
+            break
+        shutil.rmtree(fl, ignore_errors = True)
+        size = size - fl_size
+
+def convert_data(dir_path, part, empatica, n_jobs_avro, cache_dir, cache_size, f):
+    # reading in and converting the data of a participant, if a cache directory 
+    # is given the converted data is loaded from there if the raw files did not 
+    # change. The cache needs pyarrow to write and read parquet files
+    
+    # check whether the conversion is cached
+    if cache_dir is not None and pa_csv is None:
+        print(simple_colors.red('No cache used.', 'bold'), 'The cache needs pyarrow to be installed.')
+        f.write('\n' + 'No cache used. The cache needs pyarrow to be installed.')
+        cache_dir = None
+    if cache_dir is not None:
+        key = cache_key(cache_files(dir_path, part, empatica), empatica)
+        dir_entry = os.path.join(cache_dir, part + '_' + empatica + '_' + str(key))
+        if key is not None and os.path.isdir(dir_entry):
+            try:
+                dict_data = read_cache(dir_entry)
+                # mark as recently used
+                os.utime(dir_entry)
+                print(simple_colors.green(datetime.now().strftime("%H:%M:%S") + ' - conversion loaded from cache', 'bold'))
+                f.write('\n' + datetime.now().strftime("%H:%M:%S") + ' - conversion loaded from cache')
+                return dict_data
+            except Exception:
+                # any entry that cannot be read, e.g. written by an incompatible 
+                # version of pyarrow, is treated as missing and converted again
+                pass
+    
+    # read in and convert the data
+    if empatica == 'e+':
+
+        # convert eplus data
+        dict_data = convert_eplus(dir_path, part, f, n_jobs_avro)
+
+    elif empatica == 'e4':
+
+        # convert e4 data
+        dict_data = convert_e4(os.path.join(dir_path, part), part, f)
+        
+    elif empatica == 'cut':
+        
+        # convert the cut data
+        dict_data = convert_cut(dir_path, part, f)
+    
+    # save the converted data in the cache, older entries of this participant are 
+    # replaced and the directory is renamed when complete so other processes 
+    # never see partial entries
+    if cache_dir is not None and key is not None and len(dict_data) > 0:
+        if not os.path.exists(cache_dir): os.makedirs(cache_dir, exist_ok = True)
+        clear_cache(cache_dir, part)
+        dir_tmp = dir_entry + '.' + str(os.getpid())
+        shutil.rmtree(dir_tmp, ignore_errors = True)
+        write_cache(dict_data, dir_tmp)
+        try:
+            os.rename(dir_tmp, dir_entry)
+        except OSError:
+            # another process saved the same entry in the meantime
+            shutil.rmtree(dir_tmp, ignore_errors = True)
+        prune_cache(cache_dir, cache_size)
+    
+    return dict_data
+
+###### Plots
+
+# resolution of the figures in each plot mode
+plot_dpi = {'full': 300, 'fast': 100}
+
+# processes rendering the figures in the background, see plot_processes
+plot_pool    = None
+plot_futures = []
+
+def submit_plot(fun, *args):
+    # rendering a figure directly or, if plot processes are running, in the 
+    # background so the preprocessing does not wait for it
+    
+    if plot_pool is None:
+        with stage('plotting'):
+            fun(*args)
+    else:
+        plot_futures.append(plot_pool.submit(run_stage, 'plotting', *stage_ids(), None, fun, *args))
+
+@contextmanager
+def plot_processes(plot_jobs):
+    # starting plot_jobs processes which render the figures in the background, 
+    # all figures are finished when the context is left
+    
+    global plot_pool, plot_futures
+    if plot_jobs < 1:
+        yield
+        return
+    with ProcessPoolExecutor(max_workers = plot_jobs) as pool:
+        plot_pool, plot_futures = pool, []
+        try:
+            yield
+            # raise errors that occurred while plotting
+            for future in plot_futures:
+                future.result()
+        finally:
+            plot_pool, plot_futures = None, []
+
+def detach_plots():
+    # initializer of worker processes started while plot processes may be 
+    # running, the workers render their figures directly since the plot 
+    # processes belong to the parent
+    
+    global plot_pool, plot_futures
+    plot_pool, plot_futures = None, []
+
+def plot_eda(signals, info, fl, plots):
+    # plotting the preprocessed EDA with the detected SCRs, either with neurokit 
+    # or, in the fast mode and for recordings with more samples than pixels, as 
+    # min/max envelopes with one point pair per pixel of the figure width
+    
+    figsize = (100, 10) if plots == 'full' else (20, 8)
+    n_bins  = figsize[0]*plot_dpi[plots]
+    if plots == 'full' and len(signals) <= 2*n_bins:
+        matplotlib.rcParams['figure.figsize'] = figsize
+        nk.eda_plot(signals, info)
+    else:
+        x     = np.arange(len(signals))/info['sampling_rate']
+        peaks = np.where(signals['SCR_Peaks'] == 1)[0]
+        with plt.rc_context({'text.usetex': False} if plots == 'fast' else {}):
+            fig, axs = plt.subplots(2, 1, figsize = figsize, sharex = True)
+            axs[0].plot(*minMaxEnvelope(x, signals['EDA_Raw'].values, n_bins), color = '#B0BEC5', label = 'Raw')
+            axs[0].plot(*minMaxEnvelope(x, signals['EDA_Clean'].values, n_bins), color = '#9C27B0', label = 'Cleaned')
+            axs[0].set_title('Raw and Cleaned Signal')
+            axs[0].legend(loc = 'upper right')
+            axs[1].plot(*minMaxEnvelope(x, signals['EDA_Phasic'].values, n_bins), color = '#E91E63', label = 'Phasic Component')
+            axs[1].scatter(x[peaks], signals['EDA_Phasic'].values[peaks], color = '#FFC107', zorder = 3, label = 'SCR Peaks')
+            axs[1].set_title('Skin Conductance Response (SCR)')
+            axs[1].set_xlabel('Time (seconds)')
+            axs[1].legend(loc = 'upper right')
+    
+    plt.savefig(fl, dpi = plot_dpi[plots])
+    plt.close("all")
+
+def plot_bvp(signals, info, fl, plots):
+    # plotting the preprocessed BVP with the detected peaks and the heart rate, 
+    # either with neurokit including ten partial plots or, in the fast mode, as 
+    # min/max envelopes without partial plots
+    
+    if plots == 'full':
+        matplotlib.rcParams['figure.figsize'] = (20, 10)
+        nk.ppg_plot(signals, info)
+        plt.savefig(fl + '.png', dpi = plot_dpi[plots])
+        signals_split = np.array_split(signals, 10)
+        count = 0
+        for s in signals_split:
+            count = count + 1
+            # graphs can only be created when there are more than three peaks
+            if sum(s['PPG_Peaks'] == 1) > 3:
+                nk.ppg_plot(s, info)
+                plt.savefig(fl + '_' + str(count) + '.png', dpi = plot_dpi[plots])
+    else:
+        n_bins = 20*plot_dpi[plots]
+        x      = np.arange(len(signals))/info['sampling_rate']
+        peaks  = np.where(signals['PPG_Peaks'] == 1)[0]
+        with plt.rc_context({'text.usetex': False}):
+            fig, axs = plt.subplots(2, 1, figsize = (20, 8), sharex = True)
+            axs[0].plot(*minMaxEnvelope(x, signals['PPG_Raw'].values, n_bins), color = '#B0BEC5', label = 'Raw')
+            axs[0].plot(*minMaxEnvelope(x, signals['PPG_Clean'].values, n_bins), color = '#FB1CF0', label = 'Cleaned')
+            axs[0].scatter(x[peaks], signals['PPG_Clean'].values[peaks], color = '#D60574', zorder = 3, label = 'Peaks')
+            axs[0].set_title('Raw and Cleaned Signal')
+            axs[0].legend(loc = 'upper right')
+            axs[1].plot(*minMaxEnvelope(x, signals['PPG_Rate'].values, n_bins), color = '#FB661C', label = 'Rate')
+            axs[1].set_title('Heart Rate')
+            axs[1].set_xlabel('Time (seconds)')
+            axs[1].legend(loc = 'upper right')
+        plt.savefig(fl + '.png', dpi = plot_dpi[plots])
+    
+    plt.close("all")
+
+def plot_hrv(signals, sr, fl, plots):
+    # plotting the HRV indices, they are computed again by neurokit for the plot
+    
+    with plt.rc_context({'text.usetex': False} if plots == 'fast' else {}):
+        nk.hrv(signals, sampling_rate = sr, show = True)
+        plt.savefig(fl, dpi = plot_dpi[plots])
+    plt.close("all")
+
 ###### EDA
 
-def eda_prepro(dir_out, df_eda, part, key, winwidth, lowpass, f):
+def eda_prepro(dir_out, df_eda, part, key, winwidth, lowpass, f, out_format = 'csv', plots = 'full', smooth_backend = 'direct'):
     # preprocessing EDA data
 
     # get sampling rate in Hz
@@ -552,7 +1130,7 @@ def eda_prepro(dir_out, df_eda, part, key, winwidth, lowpass, f):
         data = df_eda['eda']
     
     # smooth the data - same as GAUSS option in ledalab
-    df_eda['eda_smooth'] = gauss_smoothing(data, winwidth)
+    df_eda['eda_smooth'] = gauss_smoothing(data, winwidth, smooth_backend)
     
     # process the data, including TTG to detect peaks
     signals, info = nk.eda_process(df_eda['eda_smooth'], sampling_rate = sr)
@@ -564,24 +1142,20 @@ def eda_prepro(dir_out, df_eda, part, key, winwidth, lowpass, f):
     signals = df_eda.reset_index().rename(columns={"eda": "EDA_Raw"}, errors="raise")
     
     # visualise the signals
-    matplotlib.rcParams['figure.figsize'] = (100, 10)
-    nk.eda_plot(signals, info)
-    plt.savefig(os.path.join(dir_out, part + '_' + key + '_eda_signals.png'), dpi = 300)
+    if plots != 'none':
+        submit_plot(plot_eda, signals, dict(info), os.path.join(dir_out, part + '_' + key + '_eda_signals.png'), plots)
     
-    # close all figures
-    plt.close("all") 
-    
-    # save data to csv
-    df_eda.to_csv(os.path.join(dir_out, part + '_' + key + '_eda_signals.csv'), index = True)
+    # save data as csv or in a binary format
+    write_table(df_eda, dir_out, part, key, 'eda_signals', out_format)
     info.pop('sampling_rate')
     info_df = pd.DataFrame.from_dict(info)
-    info_df.to_csv(os.path.join(dir_out, part + '_' + key + '_eda_scr.csv'), index = True)
+    write_table(info_df, dir_out, part, key, 'eda_scr', out_format)
     
     return 
 
 ###### BVP and HR
 
-def bvp_prepro(dir_out, df_bvp, part, key):
+def bvp_prepro(dir_out, df_bvp, part, key, out_format = 'csv', plots = 'full'):
     # preprocessing BVP and HR data
 
     # get sampling rate in Hz
@@ -597,137 +1171,447 @@ def bvp_prepro(dir_out, df_bvp, part, key):
     signals, info = nk.ppg_process(df_bvp['bvp'], sampling_rate = sr)
     
     # plot the data
-    matplotlib.rcParams['figure.figsize'] = (20, 10)
-    nk.ppg_plot(signals, info)
-    plt.savefig(os.path.join(dir_out, part + '_' + key + '_bvp_signals.png'), dpi = 300)
-    signals_split = np.array_split(signals, 10)
-    count = 0
-    for s in signals_split:
-        count = count + 1
-        # graphs can only be created when there are more than three peaks
-        if sum(s['PPG_Peaks'] == 1) > 3:
-            nk.ppg_plot(s, info)
-            plt.savefig(os.path.join(dir_out, part + '_' + key + '_bvp_signals_' + str(count) + '.png'), dpi = 300)
-    
-    # calculate HRV
-    hrv_indices = nk.hrv(signals, sampling_rate = info['sampling_rate'], show = True)
-    plt.savefig(os.path.join(dir_out, part + '_' + key + '_bvp_hrv.png'), dpi = 300)
-    
-    # close all figures
-    plt.close("all") 
-    
-    # save signals and hrv_indices to csv
+    if plots != 'none':
+        submit_plot(plot_bvp, signals.copy(), info, os.path.join(dir_out, part + '_' + key + '_bvp_signals'), plots)
+    
+    # calculate HRV, the figure is drawn by neurokit while calculating it unless 
+    # it is rendered in the background
+    if plots != 'none' and plot_pool is None:
+        with plt.rc_context({'text.usetex': False} if plots == 'fast' else {}):
+            hrv_indices = nk.hrv(signals, sampling_rate = info['sampling_rate'], show = True)
+            plt.savefig(os.path.join(dir_out, part + '_' + key + '_bvp_hrv.png'), dpi = plot_dpi[plots])
+        plt.close("all") 
+    else:
+        hrv_indices = nk.hrv(signals, sampling_rate = info['sampling_rate'], show = False)
+        if plots != 'none':
+            submit_plot(plot_hrv, signals.copy(), info['sampling_rate'], os.path.join(dir_out, part + '_' + key + '_bvp_hrv.png'), plots)
+    
+    # save signals and hrv_indices as csv or in a binary format
     signals.index = df_bvp.index
     df_bvp = signals.join(df_bvp)
-    df_bvp.drop(['PPG_Raw'], axis=1).to_csv(os.path.join(dir_out, part + '_' + key + '_bvp_signals.csv'), index = True)
-    hrv_indices.to_csv(os.path.join(dir_out, part + '_' + key + '_bvp_hrv.csv'), index = True)
+    write_table(df_bvp.drop(['PPG_Raw'], axis=1), dir_out, part, key, 'bvp_signals', out_format)
+    write_table(hrv_indices, dir_out, part, key, 'bvp_hrv', out_format)
     
     return 
 
+###### Checkpoints
+
+# output tables of each stage of a block
+stage_tables = {
+    'artefacts' : ['artefacts'],
+    'eda'       : ['eda_signals', 'eda_scr'],
+    'bvp'       : ['bvp_signals', 'bvp_hrv'],
+    'temp'      : ['temp'],
+    'acc'       : ['acc']
+    }
+
+def load_manifest(dir_out, part):
+    # reading the manifest of a participant which records the hash of the inputs 
+    # and parameters as well as the output files of every stage of every block
+    
+    fl = os.path.join(dir_out, part + '_manifest.json')
+    if not os.path.exists(fl):
+        return {}
+    try:
+        with open(fl) as fl_json:
+            return json.load(fl_json)
+    except ValueError:
+        return {}
+
+def save_manifest(dir_out, part, manifest):
+    # writing the manifest to a temporary file first so a crash never leaves a broken manifest
+    
+    fl = os.path.join(dir_out, part + '_manifest.json')
+    with open(fl + '.tmp', 'w') as fl_json:
+        json.dump(manifest, fl_json, indent = 1)
+    os.replace(fl + '.tmp', fl)
+
+def stage_hashes(tags, part, raw_key, winwidth, smooth_backend, art_cor, svm_model, out_format):
+    # hashing the inputs and parameters of each stage of each block, a stage 
+    # depends on the raw files, its tag and on the stages it builds on
+    
+    if svm_model is not None and os.path.exists(svm_model):
+        svm_model = [os.path.abspath(svm_model), os.stat(svm_model).st_size, os.stat(svm_model).st_mtime_ns]
+    
+    hashes = {}
+    for index, row in tags[tags['part'] == part].iterrows():
+        tag = [str(row[col]) for col in ['start', 'start_unit', 'start_buffer', 'end', 'end_unit', 'end_buffer']]
+        h_cut = hashlib.sha1(repr([raw_key, tag]).encode()).hexdigest()
+        h_art = hashlib.sha1(repr([h_cut, svm_model]).encode()).hexdigest()
+        hashes[row['tag']] = {
+            'cut'       : h_cut,
+            'artefacts' : h_art,
+            'eda'       : hashlib.sha1(repr([h_art, art_cor, winwidth, smooth_backend, out_format]).encode()).hexdigest(),
+            'bvp'       : hashlib.sha1(repr([h_art, art_cor, out_format]).encode()).hexdigest(),
+            'temp'      : hashlib.sha1(repr([h_cut, out_format]).encode()).hexdigest(),
+            'acc'       : hashlib.sha1(repr([h_cut, out_format]).encode()).hexdigest()
+            }
+    
+    return hashes
+
+def stage_done(manifest, dir_out, part, key, stage, hash_stage):
+    # checking whether a stage was run with the same hash and all its outputs still exist
+    
+    entry = manifest.get(key, {}).get(stage)
+    if entry is None or entry['hash'] != hash_stage or 'out_format' not in entry:
+        return False
+    return all([table_exists(dir_out, part, key, name, entry['out_format']) for name in entry['outputs']])
+
+def stage_record(manifest, dir_out, part, key, stage, hash_stage, out_format = 'csv', **info):
+    # recording a finished stage and its existing output tables in the manifest
+    
+    outputs = [name for name in stage_tables.get(stage, []) if table_exists(dir_out, part, key, name, out_format)]
+    manifest.setdefault(key, {})[stage] = dict(hash = hash_stage, out_format = out_format, outputs = outputs, **info)
+    save_manifest(dir_out, part, manifest)
+
+def part_done(manifest, dir_out, part, hashes, max_art):
+    # checking whether all blocks of a participant are up to date so that the 
+    # conversion and the cutting can be skipped altogether
+    
+    for key, hash_block in hashes.items():
+        if not stage_done(manifest, dir_out, part, key, 'cut', hash_block['cut']):
+            return False
+        # blocks that were skipped when cutting have no further stages
+        if not manifest[key]['cut']['block']:
+            continue
+        ls_stages = ['artefacts', 'temp', 'acc']
+        if not stage_done(manifest, dir_out, part, key, 'artefacts', hash_block['artefacts']):
+            return False
+        if manifest[key]['artefacts']['per_art'] < max_art:
+            ls_stages = ls_stages + ['eda', 'bvp']
+        for stage in ls_stages:
+            if not stage_done(manifest, dir_out, part, key, stage, hash_block[stage]):
+                return False
+    
+    return True
+
 ###### Run everything
 
-def preproPSYPHY(dir_path, dir_out, tag_file, empatica, exclude = [], winwidth = 8, lowpass = 5, max_art = 100/3, art_cor = True):
+def prepro_block(dir_out, part, key, dict_df, hash_block, manifest, record, winwidth, smooth_backend, max_art, art_cor, svm_model, art_chunk, resume, out_format, plots, pool_bvp, dir_shm, f):
+    # detecting the artefacts in one block of a participant and preprocessing 
+    # it, returns the percentage of artefacts. The manifest is only read, every 
+    # finished stage is passed on to record which writes it to the manifest
 
-    # load the tag file containing participant IDs and block information
-    tags = pd.read_csv(tag_file)
-    tags['artefact%'] = np.nan
-    ls_parts = list(tags['part'].unique())
+    # check if artifact detection already exists and, when resuming, is up to date
+    if (os.path.exists(os.path.join(dir_out, part + '_' + key + '_artefacts.csv')) and 
+        (not resume or stage_done(manifest, dir_out, part, key, 'artefacts', hash_block['artefacts']))):
+        # load it
+        labels = pd.read_csv(os.path.join(dir_out, part + '_' + key + '_artefacts.csv'), index_col=0)
+        labels['StartTime'] = pd.to_timedelta(labels['StartTime'])
+        labels['EndTime']   = pd.to_timedelta(labels['EndTime'])
+    else:
+        # detect artifacts using the EDA Explorer classifier
+        with stage('artefacts', part, key, len(dict_df['eda'])):
+            labels  = EDA_artifact_detection(dict_df, dir_out, part, key, svm_model, art_chunk, plots, submit_plot, stage)
+    per_art = sum(labels['Binary'] == -1)*100/len(labels)
+    record(key, 'artefacts', hash_block['artefacts'], per_art = per_art)
     
-    # start writing a log file
-    log_file = tag_file[:-4] + '_log.txt'
-    f = open(log_file, "a")
+    # only preprocess if less than 20% artefacts
+    if per_art < max_art:
 
-    # remove excluded participants
-    for e in exclude:
-        for part in ls_parts:
-            if e in part: 
-                ls_parts.remove(part)
+        print(simple_colors.green(datetime.now().strftime("%H:%M:%S") + ' - block ' + key + ': artifact detection done', 'bold'))
+        f.write('\n' + datetime.now().strftime("%H:%M:%S") + ' - block ' + key + ': artifact detection done')
+        
+        # check which stages have to be run
+        run_eda = not resume or not stage_done(manifest, dir_out, part, key, 'eda', hash_block['eda'])
+        run_bvp = not resume or not stage_done(manifest, dir_out, part, key, 'bvp', hash_block['bvp'])
 
-    # loop through the sorted participants
-    for part in sorted(ls_parts):
+        # the whole recording is not interpolated when it is cut, the gaps 
+        # between the files of E+ recordings are interpolated here, EDA and BVP 
+        # together with the artefacts if they are corrected
+        if 'interpolated' not in dict_df['eda'].columns:
+            with stage('int_missing', part, key, sum([len(df) for df in dict_df.values()])):
+                dict_df = dict(dict_df)
+                if len(dict_df['temp']) > 0:
+                    dict_df['temp'] = fill_missing(dict_df['temp'].copy(), ['temp'])
+                if len(dict_df['acc']) > 0:
+                    dict_df['acc'] = fill_missing(dict_df['acc'].copy(), ['accx', 'accy', 'accz'])
+                if not art_cor and (run_eda or run_bvp):
+                    dict_df['eda'], dict_df['bvp'], [], [] = int_missing(dict_df['eda'].copy(), dict_df['bvp'].copy(), [], [], f)
+
+        # replacing artefacts with NaNs and then interpolating them
+        if art_cor and (run_eda or run_bvp):
+            df_eda, df_bvp = na_missing(dict_df['eda'], dict_df['bvp'], labels)
+            with stage('int_missing', part, key, len(df_eda) + len(df_bvp)):
+                df_eda, df_bvp, [], [] = int_missing(df_eda, df_bvp, [], [], f)
+            print(simple_colors.green(datetime.now().strftime("%H:%M:%S") + ' - block ' + key + ': artifact correction done', 'bold'))
+            f.write('\n' + datetime.now().strftime("%H:%M:%S") + ' - block ' + key + ': artifact correction done')
+        else:
+            df_eda = dict_df['eda']
+            df_bvp = dict_df['bvp']
+
+        # preprocess BVP data with neurokit, if the stages overlap by the BVP 
+        # process of the participant while EDA, temp and acc are processed here. 
+        # The BVP data is passed on as memory mapped file in dir_shm
+        if pool_bvp is not None and run_bvp:
+            fl_bvp = os.path.join(dir_shm, key + '_bvp_corrected')
+            write_memmap(df_bvp, fl_bvp)
+            future_bvp = pool_bvp.submit(bvp_prepro_shared, fl_bvp, dir_out, part, key, out_format, plots)
+        
+        # preprocess EDA data with neurokit
+        if run_eda:
+            with stage('eda_prepro', part, key, len(df_eda)):
+                eda_prepro(dir_out, df_eda, part, key, winwidth, [], f, out_format, plots, smooth_backend) 
+            record(key, 'eda', hash_block['eda'], out_format)
         
-        # print a message
-        print(simple_colors.blue(datetime.now().strftime("%H:%M:%S") + ' - processing participant ' + part, 'bold'))
-        f.write('\n\n' + datetime.now().strftime("%H:%M:%S") + ' - processing participant ' + part)
+        # simply save temp and acc, if they exist
+        run_sigs = [sig for sig in ['temp', 'acc'] if not resume or not stage_done(manifest, dir_out, part, key, sig, hash_block[sig])]
+        for sig in run_sigs:
+            if len(dict_df[sig]) > 0:
+                write_table(dict_df[sig], dir_out, part, key, sig, out_format)
+        
+        # the stages are recorded in the same order as in a serial run
+        if run_bvp:
+            if pool_bvp is not None:
+                future_bvp.result()
+            else:
+                run_stage('bvp_prepro', part, key, len(df_bvp), bvp_prepro, dir_out, df_bvp, part, key, out_format, plots)
+            record(key, 'bvp', hash_block['bvp'], out_format)
+        for sig in run_sigs:
+            record(key, sig, hash_block[sig], out_format)
 
-        # read in and convert the data
-        if empatica == 'e+':
+        print(simple_colors.green(datetime.now().strftime("%H:%M:%S") + ' - block ' + key + ': preprocessing done', 'bold'))
+        f.write('\n' + datetime.now().strftime("%H:%M:%S") + ' - block ' + key + ': preprocessing done')
 
-            # convert eplus data
-            dict_data = convert_eplus(dir_path, part, f)
+    else: 
 
-        elif empatica == 'e4':
+        print(simple_colors.red(datetime.now().strftime("%H:%M:%S") + ' - block ' + key + ': STOPPED due to ' + str(round(per_art,2)) + '% artefacts', 'bold'))
+        f.write('\n' + datetime.now().strftime("%H:%M:%S") + ' - block ' + key + ': STOPPED due to ' + str(round(per_art,2)) + '% artefacts')
+    
+    return per_art
 
-            # convert e4 data
-            dict_data = convert_e4(os.path.join(dir_path, part), part, f)
-            
-        elif empatica == 'cut':
-            
-            # convert the cut data
-            dict_data = convert_cut(dir_path, part, f)
+def prepro_block_worker(dir_out, part, key, shared, hash_block, manifest, winwidth, smooth_backend, max_art, art_cor, svm_model, art_chunk, resume, out_format, plots):
+    # running prepro_block in a worker process on the shared data of a block, 
+    # the finished stages and the log are returned to the main process which 
+    # writes them to the manifest and the log file. The stages of the block 
+    # run one after the other since the block workers already use the cores
+    
+    records = []
+    def record(*args, **kwargs):
+        records.append((args, kwargs))
+    f = io.StringIO()
+    per_art = prepro_block(dir_out, part, key, load_block(shared), hash_block, manifest, record, 
+                           winwidth, smooth_backend, max_art, art_cor, svm_model, art_chunk, resume, out_format, plots, None, None, f)
+    return per_art, records, f.getvalue()
+
+def bvp_prepro_shared(fl, dir_out, part, key, out_format, plots):
+    # running bvp_prepro in the BVP process of a participant on the corrected 
+    # BVP data of a block that was written to the memory mapped file fl
+    
+    df_bvp = read_memmap(fl, mode = 'c', copy = False)
+    run_stage('bvp_prepro', part, key, len(df_bvp), bvp_prepro, dir_out, df_bvp, part, key, out_format, plots)
+    
+    # free the shared memory of the block
+    del df_bvp
+    for ext in ['.dat', '.json']:
+        os.remove(fl + ext)
+
+def shm_dir(n_bytes, f):
+    # creating a temporary directory for the data shared with worker processes, 
+    # in shared memory (/dev/shm) if it has room for n_bytes, otherwise in the 
+    # temporary directory of the system on disk
+    
+    dir_base = tempfile.gettempdir()
+    if os.path.isdir('/dev/shm'):
+        if shutil.disk_usage('/dev/shm').free > n_bytes:
+            dir_base = '/dev/shm'
+        else:
+            print(simple_colors.yellow(datetime.now().strftime("%H:%M:%S") + ' - not enough shared memory, the blocks are shared through ' + dir_base, 'bold'))
+            f.write('\n' + datetime.now().strftime("%H:%M:%S") + ' - not enough shared memory, the blocks are shared through ' + dir_base)
+    
+    return tempfile.mkdtemp(prefix = 'preproPSYPHY_', dir = dir_base)
 
-        # if no data was found for this participant, continue with the next one
-        if len(dict_data) < 1:
+def share_blocks(dict_data, dir_shm):
+    # writing the cut data frames of all blocks as raw arrays to dir_shm, which 
+    # lies in shared memory where available, so that worker processes can map 
+    # them instead of receiving pickled data frames. Returns the file and the 
+    # attributes of each data frame, signals without data stay empty lists
+    
+    dict_shared = {}
+    for key, dict_df in dict_data.items():
+        dict_shared[key] = {}
+        for sig, df in dict_df.items():
+            if isinstance(df, list):
+                dict_shared[key][sig] = df
+                continue
+            fl = os.path.join(dir_shm, key + '_' + sig)
+            write_memmap(df, fl)
+            dict_shared[key][sig] = (fl, df.attrs)
+    
+    return dict_shared
+
+def load_block(shared):
+    # mapping the data frames of one block written by share_blocks without 
+    # copying them, changes are private to the process (copy-on-write)
+    
+    dict_df = {}
+    for sig, item in shared.items():
+        if isinstance(item, list):
+            dict_df[sig] = item
             continue
+        fl, attrs = item
+        dict_df[sig] = read_memmap(fl, mode = 'c', copy = False)
+        dict_df[sig].attrs.update(attrs)
+    
+    return dict_df
+
+def prepro_part(dir_path, dir_out, tags, part, empatica, winwidth, smooth_backend, max_art, art_cor, svm_model, art_chunk, n_jobs_avro, cache_dir, cache_size, resume, out_format, plots, n_jobs_block, overlap_stages, f):
+    # converting, cutting and preprocessing all blocks of one participant, 
+    # returns a dictionary with the percentage of artefacts per block. Every 
+    # finished stage is recorded in the manifest of the participant and, if 
+    # resume is True, stages that are up to date are skipped
+
+    # create empty dictionary
+    per_arts = {}
+        
+    # print a message
+    print(simple_colors.blue(datetime.now().strftime("%H:%M:%S") + ' - processing participant ' + part, 'bold'))
+    f.write('\n\n' + datetime.now().strftime("%H:%M:%S") + ' - processing participant ' + part)
+    
+    # hash the inputs of all stages, without raw files nothing can be skipped
+    manifest = load_manifest(dir_out, part)
+    raw_key  = cache_key(cache_files(dir_path, part, empatica), empatica)
+    hashes   = stage_hashes(tags, part, raw_key, winwidth, smooth_backend, art_cor, svm_model, out_format)
+    if raw_key is None:
+        resume = False
+    
+    # check if the participant is completely up to date
+    if resume and part_done(manifest, dir_out, part, hashes, max_art):
+        for key in hashes.keys():
+            if manifest[key]['cut']['block']:
+                per_arts[key] = manifest[key]['artefacts']['per_art']
+        print(simple_colors.green(datetime.now().strftime("%H:%M:%S") + ' - all blocks are up to date', 'bold'))
+        f.write('\n' + datetime.now().strftime("%H:%M:%S") + ' - all blocks are up to date')
+        return per_arts
+
+    # read in and convert the data, possibly from the cache
+    with stage('convert', part) as record:
+        dict_data = convert_data(dir_path, part, empatica, n_jobs_avro, cache_dir, cache_size, f)
+        record['samples'] = sum([len(df) for df in dict_data.values()])
+
+    # if no data was found for this participant, continue with the next one
+    if len(dict_data) < 1:
+        return per_arts
 
-        print(simple_colors.green(datetime.now().strftime("%H:%M:%S") + ' - conversion done', 'bold'))
-        f.write('\n' + datetime.now().strftime("%H:%M:%S") + ' - conversion done')
+    print(simple_colors.green(datetime.now().strftime("%H:%M:%S") + ' - conversion done', 'bold'))
+    f.write('\n' + datetime.now().strftime("%H:%M:%S") + ' - conversion done')
 
-        # cut out the relevant blocks of data and interpolate any missing data
+    # cut out the relevant blocks of data and interpolate any missing data
+    with stage('cut', part) as record:
         dict_data = cut_data(dict_data, tags[tags['part'] == part], dir_out, f)
-        print(simple_colors.green(datetime.now().strftime("%H:%M:%S") + ' - block separation done', 'bold'))
-        f.write('\n' + datetime.now().strftime("%H:%M:%S") + ' - block separation done')
-
-        # loop through the blocks and preprocess the data
-        for key, dict_df in dict_data.items():
-
-            # check if artifact detection already exists
-            if (os.path.exists(os.path.join(dir_out, part + '_' + key + '_artefacts.csv'))):
-                # load it
-                labels = pd.read_csv(os.path.join(dir_out, part + '_' + key + '_artefacts.csv'), index_col=0)
-                labels['StartTime'] = pd.to_timedelta(labels['StartTime'])
-                labels['EndTime']   = pd.to_timedelta(labels['EndTime'])
-            else:
-                # detect artifacts using the EDA Explorer classifier
-                labels  = EDA_artifact_detection(dict_df, dir_out, part, key)
-            per_art = sum(labels['Binary'] == -1)*100/len(labels)
-            
-            # add the percent to the tags object            
-            tags['artefact%'].loc[(tags['part'] == part) & (tags['tag'] == key)] = per_art
-            
-            # only preprocess if less than 20% artefacts
-            if per_art < max_art:
-
-                print(simple_colors.green(datetime.now().strftime("%H:%M:%S") + ' - block ' + key + ': artifact detection done', 'bold'))
-                f.write('\n' + datetime.now().strftime("%H:%M:%S") + ' - block ' + key + ': artifact detection done')
-
-                # replacing artefacts with NaNs and then interpolating them
-                if art_cor:
-                    df_eda, df_bvp = na_missing(dict_df['eda'], dict_df['bvp'], labels)
-                    df_eda, df_bvp, [], [] = int_missing(df_eda, df_bvp, [], [], f)
-                    print(simple_colors.green(datetime.now().strftime("%H:%M:%S") + ' - block ' + key + ': artifact correction done', 'bold'))
-                    f.write('\n' + datetime.now().strftime("%H:%M:%S") + ' - block ' + key + ': artifact correction done')
-                else:
-                    df_eda = dict_df['eda']
-                    df_bvp = dict_df['bvp']
+        record['samples'] = sum([len(df) for dict_df in dict_data.values() for df in dict_df.values()])
+    print(simple_colors.green(datetime.now().strftime("%H:%M:%S") + ' - block separation done', 'bold'))
+    f.write('\n' + datetime.now().strftime("%H:%M:%S") + ' - block separation done')
+    for key, hash_block in hashes.items():
+        stage_record(manifest, dir_out, part, key, 'cut', hash_block['cut'], block = key in dict_data)
 
-                # preprocess EDA and BVP data with neurokit
-                eda_prepro(dir_out, df_eda, part, key, winwidth, [], f) 
-                bvp_prepro(dir_out, df_bvp, part, key)
+    # preprocess the blocks, either one after the other or distributed over 
+    # several worker processes which map the cut data from shared memory. All 
+    # blocks or, if the stages overlap, the BVP data of all blocks may be 
+    # shared at the same time
+    parallel = n_jobs_block > 1 and len(dict_data) > 1
+    dir_shm  = None
+    try:
+        if parallel or overlap_stages:
+            n_bytes = sum([df.memory_usage(index = True).sum() for dict_df in dict_data.values() 
+                           for sig, df in dict_df.items() if (parallel or sig == 'bvp') and not isinstance(df, list)])
+            dir_shm = shm_dir(n_bytes, f)
+        if parallel:
+            dict_shared = share_blocks(dict_data, dir_shm)
+            # the workers only need the shared copies of the blocks
+            del dict_data
+            with ProcessPoolExecutor(max_workers = n_jobs_block, initializer = detach_plots) as pool:
+                futures = {key: pool.submit(prepro_block_worker, dir_out, part, key, shared, hashes[key], manifest, 
+                                            winwidth, smooth_backend, max_art, art_cor, svm_model, art_chunk, resume, out_format, plots) for key, shared in dict_shared.items()}
+                
+                # collect the results in the order of the blocks so the log 
+                # file and the manifest do not depend on the timing
+                for key, future in futures.items():
+                    per_arts[key], records, log = future.result()
+                    f.write(log)
+                    for args, kwargs in records:
+                        stage_record(manifest, dir_out, part, *args, **kwargs)
+        else:
+            # if the stages overlap, one BVP process preprocesses the BVP data 
+            # of all blocks while the rest is processed here
+            with ProcessPoolExecutor(max_workers = 1, initializer = detach_plots) if overlap_stages else nullcontext() as pool_bvp:
+                record = functools.partial(stage_record, manifest, dir_out, part)
+                for key, dict_df in dict_data.items():
+                    per_arts[key] = prepro_block(dir_out, part, key, dict_df, hashes[key], manifest, record, 
+                                                 winwidth, smooth_backend, max_art, art_cor, svm_model, art_chunk, resume, out_format, plots, pool_bvp, dir_shm, f)
+    finally:
+        if dir_shm is not None:
+            shutil.rmtree(dir_shm, ignore_errors = True)
+    
+    return per_arts
 
-                # simply save temp and acc, if they exist
-                if len(dict_df['temp']) > 0:
-                    dict_df['temp'].to_csv(os.path.join(dir_out, part + '_' + key + '_temp.csv'))
-                if len(dict_df['acc']) > 0:
-                    dict_df['acc'].to_csv(os.path.join(dir_out, part + '_' + key + '_acc.csv'))
+def prepro_part_worker(dir_path, dir_out, tags, part, empatica, winwidth, smooth_backend, max_art, art_cor, svm_model, art_chunk, n_jobs_avro, cache_dir, cache_size, resume, out_format, plots, plot_jobs, n_jobs_block, overlap_stages):
+    # running prepro_part in a worker process, the log is written to a buffer
+    # and returned to the main process which writes it to the log file
+    
+    f = io.StringIO()
+    with plot_processes(plot_jobs):
+        per_arts = prepro_part(dir_path, dir_out, tags, part, empatica, winwidth, smooth_backend, max_art, art_cor, svm_model, art_chunk, n_jobs_avro, cache_dir, cache_size, resume, out_format, plots, n_jobs_block, overlap_stages, f)
+    return per_arts, f.getvalue()
 
-                print(simple_colors.green(datetime.now().strftime("%H:%M:%S") + ' - block ' + key + ': preprocessing done', 'bold'))
-                f.write('\n' + datetime.now().strftime("%H:%M:%S") + ' - block ' + key + ': preprocessing done')
+def preproPSYPHY(dir_path, dir_out, tag_file, empatica, exclude = [], winwidth = 8, lowpass = 5, max_art = 100/3, art_cor = True, n_jobs = 1, svm_model = None, art_chunk = None, n_jobs_avro = 1, cache_dir = None, cache_size = 10, resume = False, out_format = 'csv', plots = 'full', plot_jobs = 0, n_jobs_block = 1, overlap_stages = False, report = False, smooth_backend = 'direct'):
 
-            else: 
+    # check the output format, the plot mode and the smoothing backend before anything is processed
+    if out_format not in out_exts:
+        raise ValueError('out_format has to be csv, parquet, feather, hdf5 or memmap, not ' + str(out_format))
+    if plots not in ['full', 'fast', 'none']:
+        raise ValueError('plots has to be full, fast or none, not ' + str(plots))
+    if smooth_backend not in ['direct', 'fft', 'auto']:
+        raise ValueError('smooth_backend has to be direct, fft or auto, not ' + str(smooth_backend))
 
-                print(simple_colors.red(datetime.now().strftime("%H:%M:%S") + ' - block ' + key + ': STOPPED due to ' + str(round(per_art,2)) + '% artefacts', 'bold'))
-                f.write('\n' + datetime.now().strftime("%H:%M:%S") + ' - block ' + key + ': STOPPED due to ' + str(round(per_art,2)) + '% artefacts')
+    # load the tag file containing participant IDs and block information
+    tags = pd.read_csv(tag_file)
+    tags['artefact%'] = np.nan
+    ls_parts = list(tags['part'].unique())
+    
+    # start writing a log file
+    log_file = tag_file[:-4] + '_log.txt'
+    f = open(log_file, "a")
+    
+    # remove excluded participants
+    for e in exclude:
+        for part in ls_parts:
+            if e in part: 
+                ls_parts.remove(part)
+    
+    # report the time and memory of every stage, also of the worker processes
+    with report_to(tag_file[:-4] + '_stages.jsonl' if report else None):
+    
+        # loop through the sorted participants, either one after the other or 
+        # distributed over several worker processes
+        if n_jobs > 1:
+        
+            # if output directory does not exist, create it before the workers do
+            if not os.path.exists(dir_out): os.makedirs(dir_out) 
+        
+            with ProcessPoolExecutor(max_workers = n_jobs) as pool:
+                futures = [pool.submit(prepro_part_worker, dir_path, dir_out, tags[tags['part'] == part], 
+                                       part, empatica, winwidth, smooth_backend, max_art, art_cor, svm_model, art_chunk, n_jobs_avro, cache_dir, cache_size, resume, out_format, plots, plot_jobs, n_jobs_block, overlap_stages) for part in sorted(ls_parts)]
+            
+                # collect the results in the sorted order of the participants so 
+                # the log file and the tags object do not depend on the timing
+                for part, future in zip(sorted(ls_parts), futures):
+                    per_arts, log = future.result()
+                    f.write(log)
+                    for key, per_art in per_arts.items():
+                        tags.loc[(tags['part'] == part) & (tags['tag'] == key), 'artefact%'] = per_art
+    
+        else:
+        
+            with plot_processes(plot_jobs):
+                for part in sorted(ls_parts):
+                    per_arts = prepro_part(dir_path, dir_out, tags, part, empatica, winwidth, smooth_backend, max_art, art_cor, svm_model, art_chunk, n_jobs_avro, cache_dir, cache_size, resume, out_format, plots, n_jobs_block, overlap_stages, f)
+                
+                    # add the percent to the tags object  
+                    for key, per_art in per_arts.items():
+                        tags.loc[(tags['part'] == part) & (tags['tag'] == key), 'artefact%'] = per_art
                 
-    tags.to_csv(tag_file[:-4] + '_prepro.csv')
+        tags.to_csv(tag_file[:-4] + '_prepro.csv')
+        if out_format == 'hdf5':
+            compact_store(dir_out)
     f.close()
@@ -19,6 +19,20 @@ Arguments:
     lowpass    : lowpass filter frequency for EDA - has to be no larger than half the sample rate (int, default = 5)
     max_art    : maximum percent of artefacts when data is still preprocessed (0 - 100, default = 100/3)
     art_cor    : whether or not to perform artefact correction py interpolation (default = True)
+    n_jobs     : number of participants that are processed in parallel (default = 1)
+    svm_model  : path to a .npz file with the parameters of the artefact classifier (default = None, EDA Explorer classifier)
+    art_chunk  : number of 5 second epochs per window to detect artefacts with constant memory, e.g. 720 for one hour (default = None, whole block at once)
+    n_jobs_avro: number of worker processes decoding the avro files of one participant, only E+ (default = 1)
+    cache_dir  : directory in which the converted raw data is cached as parquet files for later runs, needs pyarrow (default = None, no cache)
+    cache_size : maximum size of the cache in GB, least recently used participants are removed first (default = 10)
+    resume     : whether stages that are already up to date are skipped, e.g. to continue after a crash (default = False)
+    out_format : format of the result tables, 'csv', 'parquet', 'feather' 'hdf5' for one store with all result tables or 'memmap' for raw arrays (default = 'csv')
+    plots      : 'full' for all figures at 300 dpi, 'fast' for min/max envelopes at 100 dpi without LaTeX or 'none' (default = 'full')
+    plot_jobs  : number of processes rendering the figures in the background, 0 renders them directly (default = 0)
+    n_jobs_block: number of worker processes preprocessing the blocks of one participant in parallel (default = 1)
+    overlap_stages: whether the BVP preprocessing runs in its own process alongside EDA, temp and acc of the same block, only without n_jobs_block (default = False)
+    report     : whether the wall time, CPU time, peak memory and samples of every stage are appended to *_stages.jsonl with one run id per run (default = False)
+    smooth_backend: convolution of the Gaussian smoothing of EDA, 'direct' (exact), 'fft' (faster for wide windows, differs in the last digits) or 'auto' (fft only for wide windows on long blocks) (default = 'direct')
 
 The function creates preprocessed data files for EDA and BVP as well as plots 
 to check the data quality. 
@@ -42,5 +56,9 @@ dir_out = os.path.join(os.getcwd(), 'BOKI_e4/preprocessed_data')
 empatica = 'e4'
 # list of participants that should not be processed
 exclude  = []
+# number of participants that are processed in parallel
+n_jobs   = 1
 
-preproPSYPHY(dir_path, dir_out, tag_file, empatica, exclude, art_cor = False)
+# the guard is needed so that worker processes do not start the pipeline again
+if __name__ == '__main__':
+    preproPSYPHY(dir_path, dir_out, tag_file, empatica, exclude, art_cor = False, n_jobs = n_jobs)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+
+Timing and memory report of the stages of preproPSYPHY. Every finished stage
+of a participant or block is appended as one line of JSON to a report file,
+e.g. tags_stages.jsonl next to tags_prepro.csv, with the wall time, the CPU
+time, the resident memory of the process running it at the start and the end
+and its peak during the stage as well as the number of samples processed.
+Stages can be nested, e.g. the figures drawn while preprocessing the EDA,
+their time and memory are then included in the enclosing stage which is
+saved as parent.
+
+Every run of the pipeline appends to the same report, each line therefore 
+carries the id of its run, which is the time the run started and the process 
+id of the main process, e.g. 20240101T120000-1234.
+
+The peak of each stage is measured on Linux by resetting the peak resident
+memory of the process (VmHWM) when a stage starts and reading it when it ends.
+On other systems only the peak of the whole process is known so far, this is
+marked by peak_scope = 'process' instead of 'stage'.
+
+The path of the report and the run id are kept in environment variables, so worker processes
+write their stages to the same file however they are started. Each line is
+written at once and, on systems with fcntl, with the file locked.
+
+Functions:
+    report_to    : context manager writing the stages of this process and its workers to a file
+    stage        : context manager measuring one stage
+    stage_ids    : participant and block of the innermost running stage
+    run_stage    : calling a function as stage, e.g. in a worker process
+    read_report  : reading a report, or one run of it, into a data frame
+
+"""
+
+import json
+import os
+import sys
+import time
+
+import pandas as pd
+
+from contextlib import contextmanager
+from datetime import datetime
+try:
+    # optional: peak resident memory, not available on Windows
+    import resource
+except ImportError:
+    resource = None
+try:
+    # optional: locking the report while a line is written
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# environment variables with the path of the report file and the id of the run
+report_env = 'PREPROPSYPHY_REPORT'
+run_env    = 'PREPROPSYPHY_RUN'
+
+# stages running in this process, the innermost one is the last
+stage_stack = []
+
+@contextmanager
+def report_to(fl):
+    # writing the stages of this process and of all worker processes started
+    # within the context to fl as one run with a new run id, None reports 
+    # nothing. The previous report is restored afterwards, also after an error
+
+    previous = {env: os.environ.get(env) for env in [report_env, run_env]}
+    if fl is None:
+        os.environ.pop(report_env, None)
+        os.environ.pop(run_env, None)
+    else:
+        os.environ[report_env] = os.path.abspath(fl)
+        os.environ[run_env]    = datetime.now().strftime('%Y%m%dT%H%M%S') + '-' + str(os.getpid())
+    try:
+        yield
+    finally:
+        for env, value in previous.items():
+            if value is None:
+                os.environ.pop(env, None)
+            else:
+                os.environ[env] = value
+
+def peak_rss():
+    # peak resident memory of this process in MB since it started, None where
+    # it is unknown
+
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return rss/2**20 if sys.platform == 'darwin' else rss/2**10
+
+def memory():
+    # current resident memory of this process and its peak since the last
+    # reset in MB, read from /proc on Linux, else None
+
+    try:
+        with open('/proc/self/status') as fl_status:
+            values = {line.split(':')[0]: int(line.split()[1]) for line in fl_status if line.startswith(('VmRSS', 'VmHWM'))}
+        return values['VmRSS']/2**10, values['VmHWM']/2**10
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+def reset_peak():
+    # resetting the peak resident memory of this process to the current one,
+    # only possible on Linux, returns whether it worked
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as fl_refs:
+            fl_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+def fold_peak(record):
+    # adding the peak since the last reset to the peak of a running stage
+    # before the peak is reset for a nested stage
+
+    if record.get('_peak') is not None:
+        record['_peak'] = max(record['_peak'], memory()[1])
+
+def stage_ids():
+    # participant and block of the innermost running stage
+
+    if len(stage_stack) == 0:
+        return None, None
+    return stage_stack[-1]['part'], stage_stack[-1]['block']
+
+@contextmanager
+def stage(name, part = None, block = None, samples = None, **info):
+    # measuring the stage name of a participant and block, which default to
+    # those of the enclosing stage. The record is yielded so that the samples
+    # can also be set once they are known, it is only written if the stage
+    # finishes without an error
+
+    fl = os.environ.get(report_env)
+    if fl is None:
+        yield {}
+        return
+
+    parent = stage_stack[-1] if len(stage_stack) > 0 else {}
+    fold_peak(parent)
+    rss = memory()[0]
+    record = {
+        'run'    : os.environ.get(run_env),
+        'time'   : datetime.now().isoformat(timespec = 'milliseconds'),
+        'pid'    : os.getpid(),
+        'part'   : part if part is not None else parent.get('part'),
+        'block'  : block if block is not None else parent.get('block'),
+        'stage'  : name,
+        'parent' : parent.get('stage'),
+        'samples': samples,
+        'rss_start_mb': rss,
+        '_peak'  : rss if rss is not None and reset_peak() else None
+        }
+    stage_stack.append(record)
+    wall = time.perf_counter()
+    cpu  = time.process_time()
+    try:
+        yield record
+    finally:
+        stage_stack.pop()
+    record['wall_s']      = time.perf_counter() - wall
+    record['cpu_s']       = time.process_time() - cpu
+    rss, peak = memory()
+    record['rss_end_mb'] = rss
+    if record['_peak'] is not None:
+        record['peak_rss_mb'] = max(record['_peak'], peak)
+        record['peak_scope']  = 'stage'
+    else:
+        record['peak_rss_mb'] = peak_rss()
+        record['peak_scope']  = 'process'
+    del record['_peak']
+    record.update(info)
+
+    # one write per line so the lines of several processes are not mixed
+    line = json.dumps(record, default = str) + '\n'
+    with open(fl, 'a') as fl_report:
+        if fcntl is not None:
+            fcntl.flock(fl_report, fcntl.LOCK_EX)
+        fl_report.write(line)
+
+def run_stage(name, part, block, samples, fun, *args):
+    # calling fun(*args) as stage without enclosing stages, e.g. when it is
+    # submitted to a worker process which was forked while other stages were
+    # running in the parent
+
+    outer = stage_stack[:]
+    if len(outer) > 0:
+        fold_peak(outer[-1])
+    del stage_stack[:]
+    try:
+        with stage(name, part, block, samples):
+            return fun(*args)
+    finally:
+        stage_stack[:] = outer
+
+def read_report(fl, run = 'last'):
+    # reading a report into a data frame with one row per stage, e.g. to sum up
+    # the wall time per stage with df.groupby('stage')['wall_s'].sum(). Only 
+    # the stages of the run with the id run are kept, 'last' keeps those of 
+    # the last run in the file and None keeps all runs
+
+    df = pd.read_json(fl, lines = True, convert_dates = ['time'], dtype = {'run': str})
+    if run is None or 'run' not in df.columns or len(df) == 0:
+        return df
+    if run == 'last':
+        run = df['run'].iloc[-1]
+    return df[df['run'] == run].reset_index(drop = True)